@@ -1,13 +1,54 @@
+import asyncio
+import time
 from datetime import datetime
-from typing import List, Optional
+from typing import Awaitable, Callable, List, Optional, Tuple
 from fastapi import Depends, HTTPException, status
-from LastPerson07.database import db
+from LastPerson07.database import config_cache, db
 from LastPerson07.auth import auth_manager
-from LastPerson07.models import UserInDB, ChatConfig
+from LastPerson07.models import BotSettings, ChatConfig, UserInDB, to_bson
 from LastPerson07.logger import logger
 from LastPerson07.websocket import websocket_manager
 
 
+ROLE_NAMES = ("owner", "admin", "operator", "viewer")
+VALID_ROLES = frozenset(ROLE_NAMES)
+ADMIN_ROLES = frozenset({"owner", "admin"})
+OPERATOR_ROLES = frozenset({"owner", "admin", "operator"})
+
+HEALTH_PROBE_TIMEOUT = 1.0
+
+# Fields a chat update may not set; updated_at is stamped by $currentDate
+PROTECTED_CHAT_FIELDS = frozenset({"_id", "chat_id", "updated_at"})
+
+USER_LIST_PROJECTION = {
+    "_id": 1,
+    "username": 1,
+    "email": 1,
+    "telegram_id": 1,
+    "role": 1,
+    "status": 1,
+    "created_at": 1,
+    "last_login": 1,
+}
+
+CHAT_LIST_PROJECTION = {
+    "_id": 0,
+    "chat_id": 1,
+    "chat_title": 1,
+    "chat_type": 1,
+    "enabled": 1,
+    "reaction_mode": 1,
+    "emojis": 1,
+    "delay_min": 1,
+    "delay_max": 1,
+    "react_to_media": 1,
+    "react_to_text": 1,
+    "react_to_forwards": 1,
+    "added_at": 1,
+    "added_by": 1,
+}
+
+
 class AdminManager:
     """Production-grade admin management"""
     
@@ -18,17 +59,19 @@ class AdminManager:
         current_user: UserInDB = Depends(auth_manager.get_current_user)
     ) -> List[dict]:
         """Get all users (admin/owner only)"""
-        if current_user.role not in ["owner", "admin"]:
+        if current_user.role not in ADMIN_ROLES:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="Insufficient permissions"
             )
         
-        cursor = db.get_collection("users").find().skip(skip).limit(limit)
-        users = []
+        users = await db.get_collection("users").find(
+            {},
+            projection=USER_LIST_PROJECTION,
+        ).skip(skip).limit(limit).to_list(length=limit or None)
         
-        async for user in cursor:
-            users.append({
+        return [
+            {
                 "id": str(user["_id"]),
                 "username": user["username"],
                 "email": user.get("email"),
@@ -37,9 +80,9 @@ class AdminManager:
                 "status": user["status"],
                 "created_at": user["created_at"],
                 "last_login": user.get("last_login"),
-            })
-        
-        return users
+            }
+            for user in users
+        ]
     
     @staticmethod
     async def update_user_role(
@@ -54,16 +97,15 @@ class AdminManager:
                 detail="Only owner can change user roles"
             )
         
-        valid_roles = ["owner", "admin", "operator", "viewer"]
-        if new_role not in valid_roles:
+        if new_role not in VALID_ROLES:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Invalid role. Must be one of: {', '.join(valid_roles)}"
+                detail=f"Invalid role. Must be one of: {', '.join(ROLE_NAMES)}"
             )
         
         result = await db.get_collection("users").update_one(
             {"username": username},
-            {"$set": {"role": new_role, "updated_at": datetime.utcnow()}}
+            {"$set": {"role": new_role}, "$currentDate": {"updated_at": True}}
         )
         
         if result.modified_count == 0:
@@ -72,6 +114,8 @@ class AdminManager:
                 detail="User not found"
             )
         
+        auth_manager.invalidate_user(username)
+        
         logger.info(f"User role updated: {username} -> {new_role} by {current_user.username}")
         
         return {"username": username, "new_role": new_role, "success": True}
@@ -102,6 +146,8 @@ class AdminManager:
                 detail="User not found"
             )
         
+        auth_manager.invalidate_user(username)
+        
         logger.info(f"User deleted: {username} by {current_user.username}")
         
         return {"username": username, "deleted": True}
@@ -111,17 +157,19 @@ class AdminManager:
         current_user: UserInDB = Depends(auth_manager.get_current_user)
     ) -> List[dict]:
         """Get all configured chats"""
-        if current_user.role not in ["owner", "admin", "operator"]:
+        if current_user.role not in OPERATOR_ROLES:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="Insufficient permissions"
             )
         
-        cursor = db.get_collection("chats").find().sort("added_at", -1)
-        chats = []
+        chats = await db.get_collection("chats").find(
+            {},
+            projection=CHAT_LIST_PROJECTION,
+        ).sort("added_at", -1).to_list(length=None)
         
-        async for chat in cursor:
-            chats.append({
+        return [
+            {
                 "chat_id": chat["chat_id"],
                 "chat_title": chat["chat_title"],
                 "chat_type": chat["chat_type"],
@@ -135,9 +183,9 @@ class AdminManager:
                 "react_to_forwards": chat.get("react_to_forwards", False),
                 "added_at": chat["added_at"],
                 "added_by": chat.get("added_by", "unknown"),
-            })
-        
-        return chats
+            }
+            for chat in chats
+        ]
     
     @staticmethod
     async def add_chat(
@@ -145,21 +193,21 @@ class AdminManager:
         current_user: UserInDB = Depends(auth_manager.get_current_user)
     ) -> dict:
         """Add or update chat configuration"""
-        if current_user.role not in ["owner", "admin", "operator"]:
+        if current_user.role not in OPERATOR_ROLES:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="Insufficient permissions"
             )
         
-        chat_data = chat_config.dict()
+        chat_data = to_bson(chat_config)
         chat_data["added_by"] = current_user.username
-        chat_data["updated_at"] = datetime.utcnow()
         
         result = await db.get_collection("chats").update_one(
             {"chat_id": chat_config.chat_id},
-            {"$set": chat_data},
+            {"$set": chat_data, "$currentDate": {"updated_at": True}},
             upsert=True
         )
+        config_cache.publish_chat_change(chat_config.chat_id)
         
         logger.info(f"Chat configured: {chat_config.chat_id} ({chat_config.chat_title}) by {current_user.username}")
         
@@ -181,17 +229,21 @@ class AdminManager:
         current_user: UserInDB = Depends(auth_manager.get_current_user)
     ) -> dict:
         """Update chat configuration"""
-        if current_user.role not in ["owner", "admin", "operator"]:
+        if current_user.role not in OPERATOR_ROLES:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="Insufficient permissions"
             )
         
-        updates["updated_at"] = datetime.utcnow()
+        updates = {key: value for key, value in updates.items() if key not in PROTECTED_CHAT_FIELDS}
+        
+        update_doc = {"$currentDate": {"updated_at": True}}
+        if updates:
+            update_doc["$set"] = updates
         
         result = await db.get_collection("chats").update_one(
             {"chat_id": chat_id},
-            {"$set": updates}
+            update_doc
         )
         
         if result.matched_count == 0:
@@ -199,6 +251,7 @@ class AdminManager:
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Chat not found"
             )
+        config_cache.publish_chat_change(chat_id)
         
         logger.info(f"Chat updated: {chat_id} by {current_user.username}")
         
@@ -212,7 +265,7 @@ class AdminManager:
         current_user: UserInDB = Depends(auth_manager.get_current_user)
     ) -> dict:
         """Delete chat configuration"""
-        if current_user.role not in ["owner", "admin"]:
+        if current_user.role not in ADMIN_ROLES:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="Insufficient permissions"
@@ -225,9 +278,12 @@ class AdminManager:
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Chat not found"
             )
+        config_cache.publish_chat_change(chat_id)
         
         logger.info(f"Chat deleted: {chat_id} by {current_user.username}")
         
+        await websocket_manager.notify_chat_deleted(chat_id)
+        
         return {"chat_id": chat_id, "deleted": True}
     
     @staticmethod
@@ -238,16 +294,7 @@ class AdminManager:
         settings_doc = await db.get_collection("settings").find_one({"key": "bot_settings"})
         
         if not settings_doc:
-            default_settings = {
-                "auto_react": True,
-                "default_emojis": ["❤️", "🔥", "👍", "😍", "✨"],
-                "default_delay_min": 1,
-                "default_delay_max": 5,
-                "max_retries": 3,
-                "retry_delay": 60,
-                "flood_wait_multiplier": 1.5,
-                "enable_sentiment": False,
-            }
+            default_settings = to_bson(BotSettings())
             
             await db.get_collection("settings").insert_one({
                 "key": "bot_settings",
@@ -265,7 +312,7 @@ class AdminManager:
         current_user: UserInDB = Depends(auth_manager.get_current_user)
     ) -> dict:
         """Update bot settings"""
-        if current_user.role not in ["owner", "admin"]:
+        if current_user.role not in ADMIN_ROLES:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="Insufficient permissions"
@@ -274,40 +321,68 @@ class AdminManager:
         await db.get_collection("settings").update_one(
             {"key": "bot_settings"},
             {
-                "$set": {
-                    "value": settings,
-                    "updated_at": datetime.utcnow(),
-                }
+                "$set": {"value": settings},
+                "$currentDate": {"updated_at": True},
             },
             upsert=True
         )
+        config_cache.publish_settings_change()
         
         logger.info(f"Bot settings updated by {current_user.username}")
         
         return {"success": True, "settings": settings}
     
+    @staticmethod
+    async def _run_probe(
+        name: str,
+        probe: Callable[[], Awaitable[bool]],
+    ) -> Tuple[str, bool, float]:
+        """Run a single health probe with a timeout and measure its latency"""
+        started = time.perf_counter()
+        
+        try:
+            healthy = await asyncio.wait_for(probe(), timeout=HEALTH_PROBE_TIMEOUT)
+        except Exception:
+            healthy = False
+        
+        latency_ms = round((time.perf_counter() - started) * 1000, 2)
+        return name, healthy, latency_ms
+    
+    @staticmethod
+    async def _probe_mongodb() -> bool:
+        """Ping MongoDB"""
+        await db.client.admin.command('ping')
+        return True
+    
+    @staticmethod
+    async def _probe_telegram() -> bool:
+        """Check the Telegram client state"""
+        from LastPerson07.reactions import telegram_bot
+        return telegram_bot.is_running
+    
     @staticmethod
     async def get_system_health() -> dict:
         """Get system health status"""
         try:
-            mongodb_healthy = True
-            try:
-                await db.client.admin.command('ping')
-            except:
-                mongodb_healthy = False
+            results = await asyncio.gather(
+                AdminManager._run_probe("mongodb", AdminManager._probe_mongodb),
+                AdminManager._run_probe("telegram", AdminManager._probe_telegram),
+            )
             
-            from LastPerson07.reactions import telegram_bot
-            telegram_healthy = telegram_bot.is_running
+            healthy = {name: ok for name, ok, _ in results}
+            latency_ms = {name: latency for name, _, latency in results}
             
+            from LastPerson07.reactions import telegram_bot
             bot_uptime = telegram_bot.get_uptime() if telegram_bot.is_running else 0
             
             return {
-                "status": "healthy" if (mongodb_healthy and telegram_healthy) else "degraded",
+                "status": "healthy" if all(healthy.values()) else "degraded",
                 "timestamp": datetime.utcnow(),
-                "mongodb": mongodb_healthy,
+                "mongodb": healthy["mongodb"],
                 "redis": True,
-                "telegram": telegram_healthy,
+                "telegram": healthy["telegram"],
                 "uptime": bot_uptime,
+                "latency_ms": latency_ms,
             }
         
         except Exception as e:
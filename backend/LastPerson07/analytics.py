@@ -1,174 +1,165 @@
 from datetime import datetime, timedelta
 from typing import Dict, Any, List, Optional
+from LastPerson07.cache import cached
 from LastPerson07.database import db
 from LastPerson07.logger import logger
 
 
+ERROR_STATUSES = ["error", "flood_wait"]
+
+
+def _facet_count(facets: Dict[str, Any], name: str) -> int:
+    """Extract a {"$count": "n"} sub-result from a $facet document"""
+    bucket = facets.get(name) or []
+    return bucket[0]["n"] if bucket else 0
+
+
 class AnalyticsEngine:
     """Production-grade analytics engine"""
     
+    # Cached queries raise on failure so a fallback value never gets cached;
+    # callers decide what to show instead.
+    
     @staticmethod
+    @cached("analytics", ttl=5)
     async def get_total_reactions() -> int:
         """Get total reactions count"""
-        try:
-            count = await db.get_collection("reactions").count_documents({"status": "success"})
-            return count
-        except Exception as e:
-            logger.error(f"Analytics error (total_reactions): {str(e)}")
-            return 0
+        count = await db.get_collection("reactions").count_documents({"status": "success"})
+        return count
     
     @staticmethod
+    @cached("analytics", ttl=5)
     async def get_reactions_per_second(hours: int = 1) -> float:
         """Calculate reactions per second"""
-        try:
-            start_time = datetime.utcnow() - timedelta(hours=hours)
-            
-            count = await db.get_collection("reactions").count_documents({
-                "status": "success",
-                "timestamp": {"$gte": start_time}
-            })
-            
-            seconds = hours * 3600
-            return round(count / seconds, 2) if seconds > 0 else 0.0
-        except Exception as e:
-            logger.error(f"Analytics error (reactions_per_second): {str(e)}")
-            return 0.0
+        start_time = datetime.utcnow() - timedelta(hours=hours)
+        
+        count = await db.get_collection("reactions").count_documents({
+            "status": "success",
+            "timestamp": {"$gte": start_time}
+        })
+        
+        seconds = hours * 3600
+        return round(count / seconds, 2) if seconds > 0 else 0.0
     
     @staticmethod
+    @cached("analytics", ttl=5)
     async def get_active_chats() -> int:
         """Get count of active chats"""
-        try:
-            count = await db.get_collection("chats").count_documents({"enabled": True})
-            return count
-        except Exception as e:
-            logger.error(f"Analytics error (active_chats): {str(e)}")
-            return 0
+        count = await db.get_collection("chats").count_documents({"enabled": True})
+        return count
     
     @staticmethod
+    @cached("analytics", ttl=5)
     async def get_flood_waits(hours: int = 24) -> int:
         """Get flood wait count"""
-        try:
-            start_time = datetime.utcnow() - timedelta(hours=hours)
-            
-            count = await db.get_collection("reactions").count_documents({
-                "status": "flood_wait",
-                "timestamp": {"$gte": start_time}
-            })
-            
-            return count
-        except Exception as e:
-            logger.error(f"Analytics error (flood_waits): {str(e)}")
-            return 0
+        start_time = datetime.utcnow() - timedelta(hours=hours)
+        
+        count = await db.get_collection("reactions").count_documents({
+            "status": "flood_wait",
+            "timestamp": {"$gte": start_time}
+        })
+        
+        return count
     
     @staticmethod
+    @cached("analytics", ttl=5)
     async def get_error_rate(hours: int = 24) -> float:
         """Calculate error rate percentage"""
-        try:
-            start_time = datetime.utcnow() - timedelta(hours=hours)
-            
-            total = await db.get_collection("reactions").count_documents({
-                "timestamp": {"$gte": start_time}
-            })
-            
-            errors = await db.get_collection("reactions").count_documents({
-                "status": {"$in": ["error", "flood_wait"]},
-                "timestamp": {"$gte": start_time}
-            })
-            
-            return round((errors / total * 100), 2) if total > 0 else 0.0
-        except Exception as e:
-            logger.error(f"Analytics error (error_rate): {str(e)}")
-            return 0.0
+        start_time = datetime.utcnow() - timedelta(hours=hours)
+        
+        pipeline = [
+            {
+                "$match": {
+                    "timestamp": {"$gte": start_time}
+                }
+            },
+            {
+                "$facet": {
+                    "total": [{"$count": "n"}],
+                    "errors": [
+                        {"$match": {"status": {"$in": ERROR_STATUSES}}},
+                        {"$count": "n"}
+                    ],
+                }
+            }
+        ]
+        
+        facets = await db.get_collection("reactions").aggregate(pipeline).next()
+        total = _facet_count(facets, "total")
+        errors = _facet_count(facets, "errors")
+        
+        return round((errors / total * 100), 2) if total > 0 else 0.0
     
     @staticmethod
+    @cached("analytics", ttl=30)
     async def get_emoji_usage(hours: int = 24) -> Dict[str, int]:
         """Get emoji usage statistics"""
-        try:
-            start_time = datetime.utcnow() - timedelta(hours=hours)
-            
-            pipeline = [
-                {
-                    "$match": {
-                        "status": "success",
-                        "timestamp": {"$gte": start_time}
-                    }
-                },
-                {
-                    "$group": {
-                        "_id": "$emoji",
-                        "count": {"$sum": 1}
-                    }
-                },
-                {
-                    "$sort": {"count": -1}
-                },
-                {
-                    "$limit": 20
+        start_time = datetime.utcnow() - timedelta(hours=hours)
+        
+        pipeline = [
+            {
+                "$match": {
+                    "status": "success",
+                    "timestamp": {"$gte": start_time}
                 }
-            ]
-            
-            cursor = db.get_collection("reactions").aggregate(pipeline)
-            result = {}
-            
-            async for doc in cursor:
-                result[doc["_id"]] = doc["count"]
-            
-            return result
-        except Exception as e:
-            logger.error(f"Analytics error (emoji_usage): {str(e)}")
-            return {}
+            },
+            {
+                "$group": {
+                    "_id": "$emoji",
+                    "count": {"$sum": 1}
+                }
+            },
+            {
+                "$sort": {"count": -1}
+            },
+            {
+                "$limit": 20
+            }
+        ]
+        
+        cursor = db.get_collection("reactions").aggregate(pipeline)
+        result = {}
+        
+        async for doc in cursor:
+            result[doc["_id"]] = doc["count"]
+        
+        return result
     
     @staticmethod
+    @cached("analytics", ttl=30)
     async def get_hourly_stats(hours: int = 24) -> List[Dict[str, Any]]:
         """Get hourly reaction statistics"""
-        try:
-            start_time = datetime.utcnow() - timedelta(hours=hours)
-            
-            pipeline = [
-                {
-                    "$match": {
-                        "status": "success",
-                        "timestamp": {"$gte": start_time}
-                    }
-                },
-                {
-                    "$group": {
-                        "_id": {
-                            "year": {"$year": "$timestamp"},
-                            "month": {"$month": "$timestamp"},
-                            "day": {"$dayOfMonth": "$timestamp"},
-                            "hour": {"$hour": "$timestamp"}
-                        },
-                        "count": {"$sum": 1}
-                    }
-                },
-                {
-                    "$sort": {"_id": 1}
+        start_time = datetime.utcnow() - timedelta(hours=hours)
+        
+        pipeline = [
+            {
+                "$match": {
+                    "status": "success",
+                    "timestamp": {"$gte": start_time}
                 }
-            ]
-            
-            cursor = db.get_collection("reactions").aggregate(pipeline)
-            result = []
-            
-            async for doc in cursor:
-                date_info = doc["_id"]
-                timestamp = datetime(
-                    year=date_info["year"],
-                    month=date_info["month"],
-                    day=date_info["day"],
-                    hour=date_info["hour"]
-                )
-                
-                result.append({
-                    "timestamp": timestamp.isoformat(),
-                    "hour": date_info["hour"],
-                    "count": doc["count"]
-                })
-            
-            return result
-        except Exception as e:
-            logger.error(f"Analytics error (hourly_stats): {str(e)}")
-            return []
+            },
+            {
+                "$group": {
+                    "_id": {"$dateTrunc": {"date": "$timestamp", "unit": "hour"}},
+                    "count": {"$sum": 1}
+                }
+            },
+            {
+                "$sort": {"_id": 1}
+            },
+            {
+                "$project": {
+                    "_id": 0,
+                    "timestamp": {"$dateToString": {"date": "$_id", "format": "%Y-%m-%dT%H:00:00"}},
+                    "hour": {"$hour": "$_id"},
+                    "count": 1
+                }
+            }
+        ]
+        
+        cursor = db.get_collection("reactions").aggregate(pipeline)
+        
+        return await cursor.to_list(length=hours + 1)
     
     @staticmethod
     async def get_chat_stats(chat_id: int, days: int = 7) -> Dict[str, Any]:
@@ -176,45 +167,37 @@ class AnalyticsEngine:
         try:
             start_time = datetime.utcnow() - timedelta(days=days)
             
-            total_reactions = await db.get_collection("reactions").count_documents({
-                "chat_id": chat_id,
-                "status": "success",
-                "timestamp": {"$gte": start_time}
-            })
-            
-            errors = await db.get_collection("reactions").count_documents({
-                "chat_id": chat_id,
-                "status": {"$in": ["error", "flood_wait"]},
-                "timestamp": {"$gte": start_time}
-            })
-            
             pipeline = [
                 {
                     "$match": {
                         "chat_id": chat_id,
-                        "status": "success",
                         "timestamp": {"$gte": start_time}
                     }
                 },
                 {
-                    "$group": {
-                        "_id": "$emoji",
-                        "count": {"$sum": 1}
+                    "$facet": {
+                        "success": [
+                            {"$match": {"status": "success"}},
+                            {"$count": "n"}
+                        ],
+                        "errors": [
+                            {"$match": {"status": {"$in": ERROR_STATUSES}}},
+                            {"$count": "n"}
+                        ],
+                        "emoji_usage": [
+                            {"$match": {"status": "success"}},
+                            {"$group": {"_id": "$emoji", "count": {"$sum": 1}}},
+                            {"$sort": {"count": -1}},
+                            {"$limit": 10}
+                        ],
                     }
-                },
-                {
-                    "$sort": {"count": -1}
-                },
-                {
-                    "$limit": 10
                 }
             ]
             
-            cursor = db.get_collection("reactions").aggregate(pipeline)
-            emoji_usage = {}
-            
-            async for doc in cursor:
-                emoji_usage[doc["_id"]] = doc["count"]
+            facets = await db.get_collection("reactions").aggregate(pipeline).next()
+            total_reactions = _facet_count(facets, "success")
+            errors = _facet_count(facets, "errors")
+            emoji_usage = {doc["_id"]: doc["count"] for doc in facets["emoji_usage"]}
             
             return {
                 "chat_id": chat_id,
@@ -243,24 +226,36 @@ class AnalyticsEngine:
             start_time = date.replace(hour=0, minute=0, second=0, microsecond=0)
             end_time = start_time + timedelta(days=1)
             
-            total_reactions = await db.get_collection("reactions").count_documents({
-                "status": "success",
-                "timestamp": {"$gte": start_time, "$lt": end_time}
-            })
-            
-            total_attempts = await db.get_collection("reactions").count_documents({
-                "timestamp": {"$gte": start_time, "$lt": end_time}
-            })
-            
-            errors = await db.get_collection("reactions").count_documents({
-                "status": {"$in": ["error", "flood_wait"]},
-                "timestamp": {"$gte": start_time, "$lt": end_time}
-            })
+            pipeline = [
+                {
+                    "$match": {
+                        "timestamp": {"$gte": start_time, "$lt": end_time}
+                    }
+                },
+                {
+                    "$facet": {
+                        "success": [
+                            {"$match": {"status": "success"}},
+                            {"$count": "n"}
+                        ],
+                        "errors": [
+                            {"$match": {"status": {"$in": ERROR_STATUSES}}},
+                            {"$count": "n"}
+                        ],
+                        "total": [{"$count": "n"}],
+                        "active_chats": [
+                            {"$group": {"_id": "$chat_id"}},
+                            {"$count": "n"}
+                        ],
+                    }
+                }
+            ]
             
-            active_chats = await db.get_collection("reactions").distinct(
-                "chat_id",
-                {"timestamp": {"$gte": start_time, "$lt": end_time}}
-            )
+            facets = await db.get_collection("reactions").aggregate(pipeline).next()
+            total_reactions = _facet_count(facets, "success")
+            total_attempts = _facet_count(facets, "total")
+            errors = _facet_count(facets, "errors")
+            active_chats = _facet_count(facets, "active_chats")
             
             return {
                 "date": date.strftime("%Y-%m-%d"),
@@ -268,7 +263,7 @@ class AnalyticsEngine:
                 "total_attempts": total_attempts,
                 "errors": errors,
                 "success_rate": round((total_reactions / total_attempts * 100), 2) if total_attempts > 0 else 0.0,
-                "active_chats": len(active_chats),
+                "active_chats": active_chats,
             }
         except Exception as e:
             logger.error(f"Analytics error (daily_summary): {str(e)}")
@@ -282,50 +277,57 @@ class AnalyticsEngine:
             }
     
     @staticmethod
+    @cached("analytics", ttl=60)
     async def get_top_chats(limit: int = 10, days: int = 7) -> List[Dict[str, Any]]:
         """Get top performing chats"""
-        try:
-            start_time = datetime.utcnow() - timedelta(days=days)
-            
-            pipeline = [
-                {
-                    "$match": {
-                        "status": "success",
-                        "timestamp": {"$gte": start_time}
-                    }
-                },
-                {
-                    "$group": {
-                        "_id": "$chat_id",
-                        "count": {"$sum": 1}
-                    }
-                },
-                {
-                    "$sort": {"count": -1}
-                },
-                {
-                    "$limit": limit
+        start_time = datetime.utcnow() - timedelta(days=days)
+        
+        pipeline = [
+            {
+                "$match": {
+                    "status": "success",
+                    "timestamp": {"$gte": start_time}
                 }
-            ]
-            
-            cursor = db.get_collection("reactions").aggregate(pipeline)
-            result = []
-            
-            async for doc in cursor:
-                chat_id = doc["_id"]
-                
-                chat_info = await db.get_collection("chats").find_one({"chat_id": chat_id})
-                
-                result.append({
-                    "chat_id": chat_id,
-                    "chat_title": chat_info.get("chat_title", "Unknown") if chat_info else "Unknown",
-                    "reactions": doc["count"]
-                })
-            
-            return result
-        except Exception as e:
-            logger.error(f"Analytics error (top_chats): {str(e)}")
-            return []
+            },
+            {
+                "$group": {
+                    "_id": "$chat_id",
+                    "count": {"$sum": 1}
+                }
+            },
+            {
+                "$sort": {"count": -1}
+            },
+            {
+                "$limit": limit
+            },
+            {
+                "$lookup": {
+                    "from": "chats",
+                    "localField": "_id",
+                    "foreignField": "chat_id",
+                    "as": "chat"
+                }
+            },
+            {
+                "$unwind": {
+                    "path": "$chat",
+                    "preserveNullAndEmptyArrays": True
+                }
+            },
+            {
+                "$project": {
+                    "_id": 0,
+                    "chat_id": "$_id",
+                    "chat_title": {"$ifNull": ["$chat.chat_title", "Unknown"]},
+                    "reactions": "$count"
+                }
+            }
+        ]
+        
+        cursor = db.get_collection("reactions").aggregate(pipeline)
+        
+        return [doc async for doc in cursor]
 
 
 analytics_engine = AnalyticsEngine()
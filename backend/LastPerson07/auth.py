@@ -1,30 +1,49 @@
+import asyncio
 import time
-from datetime import datetime, timedelta
-from typing import Optional, Dict, Any
+from datetime import datetime
+from typing import Optional, Dict, Any, Set, Tuple
 from fastapi import Depends, HTTPException, status, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from LastPerson07.config import settings
-from LastPerson07.database import db
-from LastPerson07.utils import decode_token, hash_password
+from pymongo import UpdateOne
+from LastPerson07.cache import cache
+from LastPerson07.database import db, RATE_LIMIT_TTL_SECONDS
+from LastPerson07.utils import ahash_password, decode_token
 from LastPerson07.models import UserInDB
 from LastPerson07.logger import logger
 
 
 security = HTTPBearer()
 
+USER_CACHE_TTL = 60
+
+RATE_LIMIT_FLUSH_INTERVAL = 0.1
+
 
 class AuthManager:
     """Production-grade authentication manager with MongoDB-based rate limiting"""
     
     def __init__(self):
-        pass
+        self._rl_pending: Dict[Tuple[str, int], int] = {}
+        self._rl_counts: Dict[Tuple[str, int], int] = {}
+        self._rl_flush_task = None
+        self._background_tasks: Set[asyncio.Task] = set()
     
     async def initialize(self):
         """Initialize auth manager"""
+        self._rl_flush_task = asyncio.create_task(self._rate_limit_flush_loop())
+        db.on_invalidate("user", self._drop_cached_user)
         logger.info("AuthManager: Initialized (MongoDB-only mode)")
     
     async def close(self):
         """Close auth manager"""
+        if self._rl_flush_task:
+            self._rl_flush_task.cancel()
+        
+        try:
+            await self._flush_rate_limits()
+        except Exception as e:
+            logger.error(f"Rate limit flush error: {str(e)}")
+        
         logger.info("AuthManager: Closed")
     
     async def get_current_user(
@@ -49,12 +68,17 @@ class AuthManager:
                 detail="Invalid token payload",
             )
         
-        user_data = await db.get_collection("users").find_one({"username": username})
-        if not user_data:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="User not found",
-            )
+        cache_key = f"user:{username}"
+        user_data = cache.get(cache_key)
+        
+        if user_data is None:
+            user_data = await db.get_collection("users").find_one({"username": username})
+            if not user_data:
+                raise HTTPException(
+                    status_code=status.HTTP_401_UNAUTHORIZED,
+                    detail="User not found",
+                )
+            cache.set(cache_key, user_data, USER_CACHE_TTL)
         
         user = UserInDB(**user_data)
         
@@ -85,7 +109,11 @@ class AuthManager:
         window: int = 60,
     ) -> bool:
         """
-        Check rate limit using MongoDB sliding window
+        Check rate limit using a MongoDB fixed-window counter
+        
+        Hits are counted in-process and flushed to MongoDB in batches every
+        RATE_LIMIT_FLUSH_INTERVAL seconds; the flush refreshes the global
+        count seen by this worker.
         
         Args:
             request: FastAPI request object
@@ -98,32 +126,77 @@ class AuthManager:
         """
         client_ip = request.client.host
         key = f"{limit_type}:{client_ip}"
-        current_time = datetime.utcnow()
-        window_start = current_time - timedelta(seconds=window)
+        now_s = time.time_ns() // 1_000_000_000
+        window_start = now_s - now_s % window
+        counter_key = (key, window_start)
         
-        await db.get_collection("rate_limits").delete_many({
-            "key": key,
-            "timestamp": {"$lt": window_start}
-        })
+        seen = self._rl_counts.get(counter_key, 0) + self._rl_pending.get(counter_key, 0)
         
-        count = await db.get_collection("rate_limits").count_documents({
-            "key": key,
-            "timestamp": {"$gte": window_start}
-        })
-        
-        if count >= limit:
+        if seen >= limit:
             raise HTTPException(
                 status_code=status.HTTP_429_TOO_MANY_REQUESTS,
                 detail="Rate limit exceeded",
             )
         
-        await db.get_collection("rate_limits").insert_one({
-            "key": key,
-            "timestamp": current_time,
-        })
+        self._rl_pending[counter_key] = self._rl_pending.get(counter_key, 0) + 1
         
         return True
     
+    async def _rate_limit_flush_loop(self):
+        """Flush buffered rate-limit hits to MongoDB"""
+        while True:
+            try:
+                await asyncio.sleep(RATE_LIMIT_FLUSH_INTERVAL)
+                await self._flush_rate_limits()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Rate limit flush error: {str(e)}")
+    
+    async def _flush_rate_limits(self):
+        """Apply pending hits in one bulk write and refresh the known counts"""
+        oldest_window = time.time_ns() // 1_000_000_000 - RATE_LIMIT_TTL_SECONDS
+        for counter_key in [k for k in self._rl_counts if k[1] < oldest_window]:
+            del self._rl_counts[counter_key]
+        
+        if not self._rl_pending:
+            return
+        
+        pending, self._rl_pending = self._rl_pending, {}
+        collection = db.get_collection("rate_limits")
+        
+        try:
+            await collection.bulk_write(
+                [
+                    UpdateOne(
+                        {"key": key, "window": window_start},
+                        [
+                            {
+                                "$set": {
+                                    "count": {"$add": [{"$ifNull": ["$count", 0]}, hits]},
+                                    "timestamp": {"$ifNull": ["$timestamp", "$$NOW"]},
+                                }
+                            }
+                        ],
+                        upsert=True,
+                    )
+                    for (key, window_start), hits in pending.items()
+                ],
+                ordered=False,
+            )
+        except Exception:
+            for counter_key, hits in pending.items():
+                self._rl_pending[counter_key] = self._rl_pending.get(counter_key, 0) + hits
+            raise
+        
+        counters = await collection.find(
+            {"$or": [{"key": key, "window": window_start} for key, window_start in pending]},
+            projection={"_id": 0, "key": 1, "window": 1, "count": 1},
+        ).to_list(length=None)
+        
+        for counter in counters:
+            self._rl_counts[(counter["key"], counter["window"])] = counter["count"]
+    
     async def create_user(
         self,
         username: str,
@@ -133,7 +206,7 @@ class AuthManager:
         status: str = "pending",
     ) -> Dict[str, Any]:
         """Create a new user"""
-        existing_user = await db.get_collection("users").find_one({"username": username})
+        existing_user = await db.get_collection("users").find_one({"username": username}, {"_id": 1})
         if existing_user:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -141,14 +214,16 @@ class AuthManager:
             )
         
         if telegram_id:
-            existing_telegram = await db.get_collection("users").find_one({"telegram_id": telegram_id})
+            existing_telegram = await db.get_collection("users").find_one(
+                {"telegram_id": telegram_id}, {"_id": 1}
+            )
             if existing_telegram:
                 raise HTTPException(
                     status_code=status.HTTP_400_BAD_REQUEST,
                     detail="Telegram ID already linked",
                 )
         
-        hashed_password = hash_password(password)
+        hashed_password = await ahash_password(password)
         
         user_data = {
             "username": username,
@@ -175,36 +250,56 @@ class AuthManager:
         """Approve a pending user"""
         result = await db.get_collection("users").update_one(
             {"username": username, "status": "pending"},
-            {"$set": {"status": "approved", "updated_at": datetime.utcnow()}},
+            {"$set": {"status": "approved"}, "$currentDate": {"updated_at": True}},
         )
         
         if result.modified_count > 0:
+            self.invalidate_user(username)
             logger.info(f"User approved: {username}")
             return True
         
         return False
     
+    def invalidate_user(self, username: str):
+        """Drop a cached user in this and every other worker so the next request reloads it"""
+        self._drop_cached_user(username)
+        db.publish_invalidation("user", username)
+    
+    def _drop_cached_user(self, username: str):
+        cache.delete(f"user:{username}")
+    
+    def record_login(self, username: str):
+        """Update the last login timestamp in the background"""
+        task = asyncio.create_task(self.update_last_login(username))
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+    
     async def update_last_login(self, username: str):
         """Update user's last login timestamp"""
-        await db.get_collection("users").update_one(
-            {"username": username},
-            {"$set": {"last_login": datetime.utcnow()}},
-        )
+        try:
+            await db.get_collection("users").update_one(
+                {"username": username},
+                {"$currentDate": {"last_login": True}},
+            )
+        except Exception as e:
+            logger.error(f"Last login update error: {str(e)}")
     
     async def get_pending_users(self) -> list[Dict[str, Any]]:
         """Get all pending users"""
-        cursor = db.get_collection("users").find({"status": "pending"})
-        users = []
+        users = await db.get_collection("users").find(
+            {"status": "pending"},
+            projection={"_id": 1, "username": 1, "telegram_id": 1, "created_at": 1},
+        ).to_list(length=None)
         
-        async for user in cursor:
-            users.append({
+        return [
+            {
                 "id": str(user["_id"]),
                 "username": user["username"],
                 "telegram_id": user.get("telegram_id"),
                 "created_at": user["created_at"],
-            })
-        
-        return users
+            }
+            for user in users
+        ]
 
 
 auth_manager = AuthManager()
@@ -0,0 +1,86 @@
+import inspect
+import time
+from functools import wraps
+from typing import Any, Callable, Dict, Tuple
+
+
+_MISSING = object()
+
+DEFAULT_MAX_SIZE = 10000
+SWEEP_INTERVAL = 60.0
+
+
+class TTLCache:
+    """Bounded in-process TTL cache; values are shared, so callers must not mutate them"""
+    
+    def __init__(self, maxsize: int = DEFAULT_MAX_SIZE):
+        self.maxsize = maxsize
+        self._store: Dict[str, Tuple[float, Any]] = {}
+        self._next_sweep = time.monotonic() + SWEEP_INTERVAL
+    
+    def get(self, key: str, default: Any = None) -> Any:
+        """Get a cached value if it has not expired"""
+        entry = self._store.get(key)
+        
+        if entry is None:
+            return default
+        
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            self._store.pop(key, None)
+            return default
+        
+        return value
+    
+    def set(self, key: str, value: Any, ttl: float):
+        """Store a value for ttl seconds, evicting the oldest entries when full"""
+        now = time.monotonic()
+        
+        if now >= self._next_sweep or len(self._store) >= self.maxsize:
+            self._purge_expired(now)
+        
+        # Re-inserting moves the key to the end of the insertion order
+        self._store.pop(key, None)
+        while len(self._store) >= self.maxsize:
+            self._store.pop(next(iter(self._store)))
+        
+        self._store[key] = (now + ttl, value)
+    
+    def delete(self, key: str):
+        """Remove a single entry"""
+        self._store.pop(key, None)
+    
+    def _purge_expired(self, now: float):
+        """Drop every expired entry"""
+        for key in [k for k, (expires_at, _) in self._store.items() if expires_at <= now]:
+            del self._store[key]
+        
+        self._next_sweep = now + SWEEP_INTERVAL
+
+
+cache = TTLCache()
+
+
+def cached(namespace: str, ttl: float) -> Callable:
+    """Cache an async function's result keyed by its bound arguments (results are shared, not copied)"""
+    
+    def decorator(func: Callable) -> Callable:
+        signature = inspect.signature(func)
+        
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = f"{namespace}:{func.__name__}:{tuple(bound.arguments.values())}"
+            
+            value = cache.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+            
+            value = await func(*args, **kwargs)
+            cache.set(key, value, ttl)
+            return value
+        
+        return wrapper
+    
+    return decorator
@@ -1,12 +1,25 @@
 import os
-from pydantic import BaseSettings
-from typing import List
+from pydantic import field_validator
+from pydantic_settings import BaseSettings, SettingsConfigDict
+from typing import List, Union
 
 
 class Settings(BaseSettings):
     # MongoDB
     MONGODB_URL: str
     DATABASE_NAME: str = "telegram_reaction_saas"
+    MONGO_MAX_POOL_SIZE: int = 32
+    MONGO_MIN_POOL_SIZE: int = 5
+    MONGO_MAX_CONNECTING: int = 4
+    MONGO_MAX_IDLE_MS: int = 60000
+    MONGO_WAIT_QUEUE_TIMEOUT_MS: int = 5000
+    MONGO_SOCKET_TIMEOUT_MS: int = 20000
+    MONGO_COMPRESSORS: str = "zstd,zlib"
+    MONGO_ZLIB_COMPRESSION_LEVEL: int = -1
+    REACTION_RETENTION_SECONDS: int = 2592000
+    ANALYTICS_RETENTION_SECONDS: int = 2592000
+    CONFIG_CACHE_TTL_SECONDS: float = 30.0
+    CONFIG_NEGATIVE_CACHE_TTL_SECONDS: float = 300.0
     
     # JWT
     JWT_SECRET: str
@@ -29,7 +42,8 @@ class Settings(BaseSettings):
     # Application
     ENVIRONMENT: str = "production"
     DEBUG: bool = False
-    CORS_ORIGINS: str = "http://localhost:3000"
+    # Union keeps pydantic-settings from JSON-decoding a comma-separated value
+    CORS_ORIGINS: Union[List[str], str] = ["http://localhost:3000"]
     API_PREFIX: str = "/api/v1"
     PORT: int = 8000
     
@@ -46,13 +60,20 @@ class Settings(BaseSettings):
     WALLPAPER_API_FALLBACK: str = "https://api.waifu.pics/sfw/waifu"
     WALLPAPER_CACHE_TTL: int = 3600
     
-    @property
-    def cors_origins_list(self) -> List[str]:
-        return [origin.strip() for origin in self.CORS_ORIGINS.split(",")]
+    @field_validator("CORS_ORIGINS", mode="before")
+    @classmethod
+    def split_cors_origins(cls, value):
+        """Split a comma-separated origin list once at load"""
+        if isinstance(value, str):
+            return [origin.strip() for origin in value.split(",") if origin.strip()]
+        return value
     
-    class Config:
-        env_file = ".env"
-        case_sensitive = True
+    model_config = SettingsConfigDict(
+        env_file=".env",
+        case_sensitive=True,
+        frozen=True,
+        extra="ignore",
+    )
 
 
 settings = Settings()
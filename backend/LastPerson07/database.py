@@ -1,8 +1,228 @@
-from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
-from pymongo import ASCENDING, DESCENDING, IndexModel
-from typing import Optional
+import asyncio
+import time
+from datetime import datetime
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection, AsyncIOMotorDatabase
+from pydantic import ValidationError
+from pymongo import ASCENDING, DESCENDING, IndexModel, UpdateOne, WriteConcern
+from pymongo.errors import BulkWriteError, CollectionInvalid, OperationFailure, PyMongoError
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
+from uuid import uuid4
 from LastPerson07.config import settings
 from LastPerson07.logger import logger
+from LastPerson07.models import BotSettings, ChatConfig
+
+
+RATE_LIMIT_TTL_SECONDS = 3600
+
+WS_EVENTS_COLLECTION = "ws_events"
+WS_EVENTS_MAX_BYTES = 1024 * 1024
+
+# Identifies this worker process on the ws_events backplane
+INSTANCE_ID = uuid4().hex
+
+WRITE_BATCH_MAX_SIZE = 500
+WRITE_BATCH_MAX_DELAY = 0.05
+WRITE_BATCH_MAX_RETRIES = 3
+WRITE_BATCH_RETRY_DELAY = 0.5
+DUPLICATE_KEY = 11000
+
+ANALYTICS_FLUSH_INTERVAL = 1.0
+
+CONFIG_CACHE_MAX_CHATS = 10000
+CONFIG_WATCH_RETRY_DELAY = 5.0
+CHANGE_STREAM_UNSUPPORTED = 40573
+NAMESPACE_EXISTS = 48
+INDEX_NOT_FOUND = 27
+
+# Single-field indexes that are prefixes of compound indexes (or were
+# replaced by partial ones) and only add write amplification.
+OBSOLETE_INDEXES = {
+    "users": ("status_1", "role_1"),
+    "reactions": ("chat_id_1", "status_1", "timestamp_-1"),
+    "analytics": ("timestamp_-1", "date_-1"),
+}
+
+
+class WriteBatcher:
+    """Buffer inserts for a collection and flush them with unordered insert_many"""
+    
+    def __init__(
+        self,
+        collection_name: str,
+        max_batch: int = WRITE_BATCH_MAX_SIZE,
+        max_delay: float = WRITE_BATCH_MAX_DELAY,
+    ):
+        self.collection_name = collection_name
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.task: Optional[asyncio.Task] = None
+        self._collection: Optional[AsyncIOMotorCollection] = None
+        self.dropped = 0
+    
+    def start(self):
+        """Start the background flush task"""
+        self.task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Stop the flush task and write out anything still queued"""
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        
+        batch = []
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        
+        if batch:
+            await self._flush(batch)
+    
+    def enqueue(self, document: Dict[str, Any]):
+        """Queue a document for the next batch"""
+        self.queue.put_nowait(document)
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            
+            try:
+                while len(batch) < self.max_batch:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+            finally:
+                await self._flush(batch)
+    
+    async def _flush(self, batch: List[Dict[str, Any]]):
+        if self._collection is None:
+            self._collection = Database.get_collection(self.collection_name).with_options(
+                write_concern=WriteConcern(w=1, j=False)
+            )
+        
+        for attempt in range(WRITE_BATCH_MAX_RETRIES + 1):
+            try:
+                await self._collection.insert_many(
+                    batch,
+                    ordered=False,
+                    bypass_document_validation=True,
+                )
+                return
+            except BulkWriteError as e:
+                # Unordered inserts keep going; retry only the documents that
+                # failed, treating duplicate keys as written by an earlier try
+                failed = {
+                    error["index"]
+                    for error in e.details.get("writeErrors", [])
+                    if error.get("code") != DUPLICATE_KEY
+                }
+                batch = [batch[index] for index in sorted(failed)]
+                last_error = e
+            except Exception as e:
+                last_error = e
+            
+            if not batch:
+                return
+            
+            if attempt < WRITE_BATCH_MAX_RETRIES:
+                try:
+                    await asyncio.sleep(WRITE_BATCH_RETRY_DELAY * 2 ** attempt)
+                except asyncio.CancelledError:
+                    # Hand the documents back so stop() writes them out
+                    for document in batch:
+                        self.queue.put_nowait(document)
+                    raise
+        
+        self.dropped += len(batch)
+        logger.error(
+            f"Batched insert into {self.collection_name} failed, dropped {len(batch)} documents "
+            f"({self.dropped} total): {str(last_error)}"
+        )
+
+
+class AnalyticsRollup:
+    """Accumulate analytics counters in memory and flush them as hourly $inc upserts"""
+    
+    def __init__(self, interval: float = ANALYTICS_FLUSH_INTERVAL):
+        self.interval = interval
+        self.pending: Dict[Tuple[str, datetime, Tuple], float] = {}
+        self.task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        """Start the background flush task"""
+        self.task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Stop the flush task and write out any pending counts"""
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        
+        await self._flush()
+    
+    def increment(self, metric_type: str, value: float, metadata: Optional[Dict[str, Any]] = None):
+        """Add value to the current hour's bucket for this metric and metadata"""
+        hour_start = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+        key = (metric_type, hour_start, tuple(sorted((metadata or {}).items())))
+        self.pending[key] = self.pending.get(key, 0) + value
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self._flush()
+    
+    async def _flush(self):
+        if not self.pending:
+            return
+        
+        pending, self.pending = self.pending, {}
+        requests = [
+            UpdateOne(
+                {
+                    "metric_type": metric_type,
+                    "date": hour_start.strftime("%Y-%m-%d"),
+                    "hour": hour_start.hour,
+                    "metadata": dict(metadata),
+                    "rollup": True,
+                },
+                {
+                    "$inc": {"value": value},
+                    "$setOnInsert": {"timestamp": hour_start},
+                },
+                upsert=True,
+            )
+            for (metric_type, hour_start, metadata), value in pending.items()
+        ]
+        keys = list(pending)
+        
+        try:
+            await Database.get_collection("analytics").bulk_write(requests, ordered=False)
+            return
+        except BulkWriteError as e:
+            # Unordered writes keep going, so only the failed buckets are retried
+            failed = [keys[error["index"]] for error in e.details.get("writeErrors", [])]
+            logger.error(f"Analytics rollup flush failed for {len(failed)} buckets: {str(e)}")
+        except Exception as e:
+            failed = keys
+            logger.error(f"Analytics rollup flush failed: {str(e)}")
+        
+        # Fold the unwritten counts back in for the next flush
+        for key in failed:
+            self.pending[key] = self.pending.get(key, 0) + pending[key]
 
 
 class Database:
@@ -10,6 +230,11 @@ class Database:
     
     client: Optional[AsyncIOMotorClient] = None
     db: Optional[AsyncIOMotorDatabase] = None
+    collections: Dict[str, AsyncIOMotorCollection] = {}
+    reaction_writer: Optional[WriteBatcher] = None
+    analytics_rollup: Optional[AnalyticsRollup] = None
+    invalidation_handlers: Dict[str, Callable[[Any], None]] = {}
+    background_tasks: Set[asyncio.Task] = set()
     
     @classmethod
     async def connect(cls):
@@ -17,15 +242,32 @@ class Database:
         try:
             cls.client = AsyncIOMotorClient(
                 settings.MONGODB_URL,
-                maxPoolSize=50,
-                minPoolSize=10,
+                maxPoolSize=settings.MONGO_MAX_POOL_SIZE,
+                minPoolSize=settings.MONGO_MIN_POOL_SIZE,
+                maxConnecting=settings.MONGO_MAX_CONNECTING,
+                maxIdleTimeMS=settings.MONGO_MAX_IDLE_MS,
+                waitQueueTimeoutMS=settings.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+                socketTimeoutMS=settings.MONGO_SOCKET_TIMEOUT_MS,
+                compressors=settings.MONGO_COMPRESSORS or None,
+                zlibCompressionLevel=settings.MONGO_ZLIB_COMPRESSION_LEVEL,
+                retryWrites=True,
+                retryReads=True,
                 serverSelectionTimeoutMS=5000,
             )
             cls.db = cls.client[settings.DATABASE_NAME]
+            cls.collections = {}
             
+            await cls._create_capped_collections()
             await cls._create_indexes()
             
             await cls.client.admin.command('ping')
+            
+            cls.reaction_writer = WriteBatcher("reactions")
+            cls.reaction_writer.start()
+            cls.analytics_rollup = AnalyticsRollup()
+            cls.analytics_rollup.start()
+            config_cache.start()
+            
             logger.info("Successfully connected to MongoDB")
             
         except Exception as e:
@@ -35,10 +277,42 @@ class Database:
     @classmethod
     async def disconnect(cls):
         """Close MongoDB connection"""
+        await config_cache.stop()
+        
+        if cls.reaction_writer:
+            await cls.reaction_writer.stop()
+            cls.reaction_writer = None
+        
+        if cls.analytics_rollup:
+            await cls.analytics_rollup.stop()
+            cls.analytics_rollup = None
+        
         if cls.client:
             cls.client.close()
+            cls.collections = {}
             logger.info("Disconnected from MongoDB")
     
+    @classmethod
+    async def _create_capped_collections(cls):
+        """Create capped collections used as tailable event logs"""
+        existing = await cls.db.list_collection_names(filter={"name": WS_EVENTS_COLLECTION})
+        
+        if existing:
+            return
+        
+        # Workers starting together on a fresh database race to create it
+        try:
+            await cls.db.create_collection(
+                WS_EVENTS_COLLECTION,
+                capped=True,
+                size=WS_EVENTS_MAX_BYTES,
+            )
+        except CollectionInvalid:
+            pass
+        except OperationFailure as e:
+            if e.code != NAMESPACE_EXISTS:
+                raise
+    
     @classmethod
     async def _create_indexes(cls):
         """Create all required indexes for optimal performance"""
@@ -47,22 +321,27 @@ class Database:
             IndexModel([("username", ASCENDING)], unique=True),
             IndexModel([("telegram_id", ASCENDING)], unique=True, sparse=True),
             IndexModel([("email", ASCENDING)], sparse=True),
-            IndexModel([("status", ASCENDING)]),
-            IndexModel([("role", ASCENDING)]),
+            IndexModel(
+                [("status", ASCENDING)],
+                name="status_pending",
+                partialFilterExpression={"status": "pending"},
+            ),
             IndexModel([("created_at", DESCENDING)]),
         ]
-        await cls.db.users.create_indexes(users_indexes)
         
         reactions_indexes = [
-            IndexModel([("chat_id", ASCENDING)]),
             IndexModel([("message_id", ASCENDING)]),
             IndexModel([("user_id", ASCENDING)]),
-            IndexModel([("timestamp", DESCENDING)]),
+            IndexModel([("timestamp", ASCENDING)], expireAfterSeconds=settings.REACTION_RETENTION_SECONDS),
             IndexModel([("emoji", ASCENDING)]),
-            IndexModel([("status", ASCENDING)]),
             IndexModel([("chat_id", ASCENDING), ("timestamp", DESCENDING)]),
+            IndexModel([("status", ASCENDING), ("timestamp", DESCENDING)]),
+            IndexModel([("chat_id", ASCENDING), ("status", ASCENDING), ("timestamp", DESCENDING)]),
+            IndexModel(
+                [("timestamp", DESCENDING), ("status", ASCENDING), ("emoji", ASCENDING)],
+                partialFilterExpression={"status": "success"},
+            ),
         ]
-        await cls.db.reactions.create_indexes(reactions_indexes)
         
         chats_indexes = [
             IndexModel([("chat_id", ASCENDING)], unique=True),
@@ -70,30 +349,268 @@ class Database:
             IndexModel([("chat_type", ASCENDING)]),
             IndexModel([("added_at", DESCENDING)]),
         ]
-        await cls.db.chats.create_indexes(chats_indexes)
         
         analytics_indexes = [
-            IndexModel([("timestamp", DESCENDING)]),
+            IndexModel([("timestamp", ASCENDING)], expireAfterSeconds=settings.ANALYTICS_RETENTION_SECONDS),
             IndexModel([("metric_type", ASCENDING)]),
-            IndexModel([("date", DESCENDING)]),
+            IndexModel([("date", ASCENDING), ("metric_type", ASCENDING)]),
+            IndexModel([("date", ASCENDING), ("hour", ASCENDING), ("metric_type", ASCENDING)]),
             IndexModel([("hour", DESCENDING)]),
+            # One bucket per metric, hour and metadata even when several
+            # workers upsert it for the first time concurrently
+            IndexModel(
+                [("metric_type", ASCENDING), ("date", ASCENDING), ("hour", ASCENDING), ("metadata", ASCENDING)],
+                unique=True,
+                partialFilterExpression={"rollup": True},
+            ),
         ]
-        await cls.db.analytics.create_indexes(analytics_indexes)
         
         settings_indexes = [
             IndexModel([("key", ASCENDING)], unique=True),
             IndexModel([("updated_at", DESCENDING)]),
         ]
-        await cls.db.settings.create_indexes(settings_indexes)
+        
+        emoji_positions_indexes = [
+            IndexModel([("chat_id", ASCENDING)], unique=True),
+        ]
+        
+        cache_indexes = [
+            IndexModel([("key", ASCENDING)], unique=True),
+            IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+        ]
+        
+        rate_limits_indexes = [
+            IndexModel(
+                [("key", ASCENDING), ("window", ASCENDING)],
+                unique=True,
+                partialFilterExpression={"window": {"$exists": True}},
+            ),
+            IndexModel([("timestamp", ASCENDING)], expireAfterSeconds=RATE_LIMIT_TTL_SECONDS),
+        ]
+        
+        await asyncio.gather(
+            cls._ensure_indexes(cls.db.users, users_indexes, OBSOLETE_INDEXES["users"]),
+            cls._ensure_indexes(cls.db.reactions, reactions_indexes, OBSOLETE_INDEXES["reactions"]),
+            cls._ensure_indexes(cls.db.chats, chats_indexes),
+            cls._ensure_indexes(cls.db.analytics, analytics_indexes, OBSOLETE_INDEXES["analytics"]),
+            cls._ensure_indexes(cls.db.settings, settings_indexes),
+            cls._ensure_indexes(cls.db.emoji_positions, emoji_positions_indexes),
+            cls._ensure_indexes(cls.db.cache, cache_indexes),
+            cls._ensure_indexes(cls.db.rate_limits, rate_limits_indexes),
+        )
         
         logger.info("Successfully created all database indexes")
     
+    @staticmethod
+    async def _ensure_indexes(
+        collection: AsyncIOMotorCollection,
+        indexes: List[IndexModel],
+        obsolete: Sequence[str] = (),
+    ):
+        """Create only the indexes that are not already present on the collection"""
+        existing = await collection.index_information()
+        
+        for name in obsolete:
+            if name in existing:
+                # Another worker starting at the same time may drop it first
+                try:
+                    await collection.drop_index(name)
+                except OperationFailure as e:
+                    if e.code != INDEX_NOT_FOUND:
+                        raise
+                    continue
+                logger.info(f"Dropped obsolete index {collection.name}.{name}")
+        missing = [index for index in indexes if index.document["name"] not in existing]
+        
+        if missing:
+            await collection.create_indexes(missing)
+    
     @classmethod
-    def get_collection(cls, name: str):
-        """Get a collection from the database"""
-        if cls.db is None:
+    def on_invalidate(cls, kind: str, handler: Callable[[Any], None]):
+        """Register the local handler for cache invalidations from other workers"""
+        cls.invalidation_handlers[kind] = handler
+    
+    @classmethod
+    def publish_invalidation(cls, kind: str, key: Any = None):
+        """Tell other workers over the ws_events backplane to drop a cached entry"""
+        task = asyncio.create_task(cls._publish_invalidation(kind, key))
+        cls.background_tasks.add(task)
+        task.add_done_callback(cls.background_tasks.discard)
+    
+    @classmethod
+    async def _publish_invalidation(cls, kind: str, key: Any):
+        try:
+            await cls.get_collection(WS_EVENTS_COLLECTION).insert_one({
+                "origin": INSTANCE_ID,
+                "invalidate": kind,
+                "key": key,
+            })
+        except Exception as e:
+            logger.error(f"Error publishing cache invalidation: {str(e)}")
+    
+    @classmethod
+    def apply_invalidation(cls, event: Dict[str, Any]):
+        """Run the local handler for an invalidation received from another worker"""
+        handler = cls.invalidation_handlers.get(event["invalidate"])
+        if handler is not None:
+            handler(event.get("key"))
+    
+    @classmethod
+    def enqueue_reaction(cls, document: Dict[str, Any]):
+        """Queue a reaction record for batched insertion"""
+        if cls.reaction_writer is None:
             raise RuntimeError("Database not connected")
-        return cls.db[name]
+        cls.reaction_writer.enqueue(document)
+    
+    @classmethod
+    def increment_analytics(cls, metric_type: str, value: float, metadata: Optional[Dict[str, Any]] = None):
+        """Add to the hourly analytics counter for a metric"""
+        if cls.analytics_rollup is None:
+            raise RuntimeError("Database not connected")
+        cls.analytics_rollup.increment(metric_type, value, metadata)
+    
+    @classmethod
+    def get_collection(cls, name: str) -> AsyncIOMotorCollection:
+        """Get a collection from the database, reusing the handle across calls"""
+        collection = cls.collections.get(name)
+        
+        if collection is None:
+            if cls.db is None:
+                raise RuntimeError("Database not connected")
+            collection = cls.collections[name] = cls.db[name]
+        
+        return collection
+
+
+class ConfigCache:
+    """In-process cache of validated chat configs and bot settings"""
+    
+    def __init__(
+        self,
+        ttl: float = settings.CONFIG_CACHE_TTL_SECONDS,
+        negative_ttl: float = settings.CONFIG_NEGATIVE_CACHE_TTL_SECONDS,
+    ):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._chats: Dict[int, Tuple[float, Optional[ChatConfig]]] = {}
+        self._bot_settings: Optional[Tuple[float, BotSettings]] = None
+        self.watch_task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        """Start listening for config changes made by other processes"""
+        Database.on_invalidate("chat", self.invalidate_chat)
+        Database.on_invalidate("settings", lambda _: self.invalidate_settings())
+        self.watch_task = asyncio.create_task(self._watch())
+    
+    async def stop(self):
+        """Stop the change stream listener and drop cached entries"""
+        if self.watch_task:
+            self.watch_task.cancel()
+            try:
+                await self.watch_task
+            except asyncio.CancelledError:
+                pass
+            self.watch_task = None
+        
+        self.clear()
+    
+    async def get_chat(self, chat_id: int) -> Optional[ChatConfig]:
+        """Get a chat's config, or None if the chat is not configured"""
+        entry = self._chats.get(chat_id)
+        now = time.monotonic()
+        
+        if entry is not None and now < entry[0]:
+            return entry[1]
+        
+        config = None
+        doc = await Database.get_collection("chats").find_one({"chat_id": chat_id})
+        
+        if doc:
+            try:
+                config = ChatConfig.model_validate(doc)
+            except ValidationError as e:
+                logger.error(f"Invalid config for chat {chat_id}: {str(e)}")
+        
+        if entry is None and len(self._chats) >= CONFIG_CACHE_MAX_CHATS:
+            self._chats.pop(next(iter(self._chats)))
+        
+        # Most chats the bot sits in are never configured; remember those for
+        # longer. Admin writes clear them in every worker via the backplane.
+        self._chats[chat_id] = (now + (self.ttl if config else self.negative_ttl), config)
+        return config
+    
+    async def get_bot_settings(self) -> BotSettings:
+        """Get the global bot settings"""
+        entry = self._bot_settings
+        now = time.monotonic()
+        
+        if entry is not None and now - entry[0] < self.ttl:
+            return entry[1]
+        
+        bot_settings = BotSettings()
+        doc = await Database.get_collection("settings").find_one({"key": "bot_settings"})
+        
+        if doc:
+            try:
+                bot_settings = BotSettings.model_validate(doc.get("value", {}))
+            except ValidationError as e:
+                logger.error(f"Invalid bot settings, using defaults: {str(e)}")
+        
+        self._bot_settings = (now, bot_settings)
+        return bot_settings
+    
+    def invalidate_chat(self, chat_id: int):
+        """Forget a single chat's config"""
+        self._chats.pop(chat_id, None)
+    
+    def invalidate_settings(self):
+        """Forget the cached bot settings"""
+        self._bot_settings = None
+    
+    def publish_chat_change(self, chat_id: int):
+        """Forget a chat's config here and in every other worker"""
+        self.invalidate_chat(chat_id)
+        Database.publish_invalidation("chat", chat_id)
+    
+    def publish_settings_change(self):
+        """Forget the bot settings here and in every other worker"""
+        self.invalidate_settings()
+        Database.publish_invalidation("settings")
+    
+    def clear(self):
+        """Forget everything"""
+        self._chats.clear()
+        self._bot_settings = None
+    
+    async def _watch(self):
+        # Change events for updates and deletes only carry _id, so any chat
+        # change drops every cached chat; config writes are rare.
+        pipeline = [{
+            "$match": {
+                "ns.coll": {"$in": ["chats", "settings"]},
+                "operationType": {"$in": ["insert", "update", "replace", "delete"]},
+            }
+        }]
+        
+        while True:
+            try:
+                async with Database.db.watch(pipeline) as stream:
+                    async for change in stream:
+                        if change["ns"]["coll"] == "chats":
+                            self._chats.clear()
+                        else:
+                            self.invalidate_settings()
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAM_UNSUPPORTED:
+                    logger.info("Change streams unavailable, config cache relies on TTL expiry")
+                    return
+                logger.error(f"Config change stream failed: {str(e)}")
+            except PyMongoError as e:
+                logger.error(f"Config change stream failed: {str(e)}")
+            
+            self.clear()
+            await asyncio.sleep(CONFIG_WATCH_RETRY_DELAY)
 
 
 db = Database
+config_cache = ConfigCache()
@@ -1,9 +1,30 @@
+import atexit
 import logging
+import os
+import queue
 import sys
-from datetime import datetime
+import threading
+import time
 from pathlib import Path
-from typing import Any
-from logging.handlers import RotatingFileHandler
+from typing import Any, Optional
+from logging.handlers import (
+    MemoryHandler,
+    QueueHandler,
+    QueueListener,
+    RotatingFileHandler,
+)
+
+
+LOG_BUFFER_CAPACITY = 1024
+LOG_FLUSH_INTERVAL = 5.0
+LOG_RETENTION_DAYS = 14
+
+logging.logProcesses = False
+logging.logThreads = False
+logging.logMultiprocessing = False
+# Skip the findCaller stack walk on every record; ERROR and above resolve
+# their call site explicitly in Logger._log_with_source.
+logging._srcfile = None
 
 
 class ColoredFormatter(logging.Formatter):
@@ -24,12 +45,55 @@ class ColoredFormatter(logging.Formatter):
         logging.CRITICAL: bold_red + "%(asctime)s - %(name)s - %(levelname)s - %(message)s" + reset,
     }
     
+    def __init__(self):
+        super().__init__(datefmt="%Y-%m-%d %H:%M:%S")
+        self._formatters = {
+            level: logging.Formatter(fmt, datefmt="%Y-%m-%d %H:%M:%S")
+            for level, fmt in self.FORMATS.items()
+        }
+    
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt, datefmt="%Y-%m-%d %H:%M:%S")
+        formatter = self._formatters.get(record.levelno)
+        if formatter is None:
+            return super().format(record)
         return formatter.format(record)
 
 
+class DailyFileHandler(logging.FileHandler):
+    """Append to one YYYY-MM-DD.log file per UTC day, never renaming, so worker processes can share it"""
+    
+    def __init__(self, log_dir: Path, retention_days: int):
+        self.log_dir = log_dir
+        self.retention_days = retention_days
+        self.rollover_at = 0.0
+        super().__init__(self._path_for(time.time()), mode="a", delay=True)
+        self.rollover_at = self._next_midnight(time.time())
+    
+    @staticmethod
+    def _next_midnight(timestamp: float) -> float:
+        return (int(timestamp) // 86400 + 1) * 86400
+    
+    def _path_for(self, timestamp: float) -> Path:
+        return self.log_dir / f"{time.strftime('%Y-%m-%d', time.gmtime(timestamp))}.log"
+    
+    def emit(self, record):
+        if record.created >= self.rollover_at:
+            self.close()
+            self.baseFilename = os.path.abspath(self._path_for(record.created))
+            self.rollover_at = self._next_midnight(record.created)
+            self._prune()
+        
+        super().emit(record)
+    
+    def _prune(self):
+        """Delete daily files beyond the retention window"""
+        for path in sorted(self.log_dir.glob("????-??-??.log"))[:-self.retention_days]:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+
 class Logger:
     """Production-grade structured logger"""
     
@@ -38,6 +102,9 @@ class Logger:
         self.logger.setLevel(logging.INFO)
         self.log_dir = Path(log_dir)
         self.log_dir.mkdir(exist_ok=True)
+        self.listener: Optional[QueueListener] = None
+        self.flusher: Optional[threading.Thread] = None
+        self.flush_stop = threading.Event()
         
         if not self.logger.handlers:
             self._setup_handlers()
@@ -47,11 +114,7 @@ class Logger:
         console_handler.setLevel(logging.INFO)
         console_handler.setFormatter(ColoredFormatter())
         
-        file_handler = RotatingFileHandler(
-            self.log_dir / f"{datetime.now().strftime('%Y-%m-%d')}.log",
-            maxBytes=10 * 1024 * 1024,
-            backupCount=10,
-        )
+        file_handler = DailyFileHandler(self.log_dir, LOG_RETENTION_DAYS)
         file_handler.setLevel(logging.INFO)
         file_handler.setFormatter(
             logging.Formatter(
@@ -64,6 +127,7 @@ class Logger:
             self.log_dir / "error.log",
             maxBytes=10 * 1024 * 1024,
             backupCount=10,
+            delay=True,
         )
         error_handler.setLevel(logging.ERROR)
         error_handler.setFormatter(
@@ -73,24 +137,93 @@ class Logger:
             )
         )
         
-        self.logger.addHandler(console_handler)
-        self.logger.addHandler(file_handler)
-        self.logger.addHandler(error_handler)
+        buffered_file_handler = MemoryHandler(
+            capacity=LOG_BUFFER_CAPACITY,
+            flushLevel=logging.ERROR,
+            target=file_handler,
+        )
+        buffered_file_handler.setLevel(logging.INFO)
+        
+        # Bound how long buffered lines wait on disk on a quiet instance
+        self.flusher = threading.Thread(
+            target=self._flush_loop,
+            args=(buffered_file_handler,),
+            name="log-flusher",
+            daemon=True,
+        )
+        self.flusher.start()
+        
+        log_queue = queue.SimpleQueue()
+        self.listener = QueueListener(
+            log_queue,
+            console_handler,
+            buffered_file_handler,
+            error_handler,
+            respect_handler_level=True,
+        )
+        self.listener.start()
+        atexit.register(self.stop)
+        
+        self.logger.addHandler(QueueHandler(log_queue))
+    
+    def _flush_loop(self, handler: MemoryHandler):
+        """Flush the buffered file handler every LOG_FLUSH_INTERVAL seconds and once on stop"""
+        while not self.flush_stop.wait(LOG_FLUSH_INTERVAL):
+            handler.flush()
+        
+        handler.flush()
+    
+    def stop(self):
+        """Drain queued records, flush buffered lines and stop the background threads"""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        
+        if self.flusher is not None:
+            self.flush_stop.set()
+            self.flusher.join()
+            self.flusher = None
     
     def info(self, message: str, **kwargs: Any):
-        self.logger.info(message, extra=kwargs)
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(message, extra=kwargs or None)
     
     def warning(self, message: str, **kwargs: Any):
-        self.logger.warning(message, extra=kwargs)
+        if self.logger.isEnabledFor(logging.WARNING):
+            self.logger.warning(message, extra=kwargs or None)
     
-    def error(self, message: str, **kwargs: Any):
-        self.logger.error(message, extra=kwargs)
+    def error(self, message: str, exc_info: Any = None, **kwargs: Any):
+        if self.logger.isEnabledFor(logging.ERROR):
+            self._log_with_source(logging.ERROR, message, exc_info, kwargs)
     
     def debug(self, message: str, **kwargs: Any):
-        self.logger.debug(message, extra=kwargs)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(message, extra=kwargs or None)
     
-    def critical(self, message: str, **kwargs: Any):
-        self.logger.critical(message, extra=kwargs)
-
+    def critical(self, message: str, exc_info: Any = None, **kwargs: Any):
+        if self.logger.isEnabledFor(logging.CRITICAL):
+            self._log_with_source(logging.CRITICAL, message, exc_info, kwargs)
+    
+    def _log_with_source(self, level: int, message: str, exc_info: Any, extra: dict):
+        """Emit a record carrying the wrapper caller's file, line and function"""
+        frame = sys._getframe(2)
+        
+        if isinstance(exc_info, BaseException):
+            exc_info = (type(exc_info), exc_info, exc_info.__traceback__)
+        elif exc_info and not isinstance(exc_info, tuple):
+            exc_info = sys.exc_info()
+        
+        record = self.logger.makeRecord(
+            self.logger.name,
+            level,
+            frame.f_code.co_filename,
+            frame.f_lineno,
+            message,
+            None,
+            exc_info or None,
+            frame.f_code.co_name,
+            extra or None,
+        )
+        self.logger.handle(record)
 
 logger = Logger("telegram_saas")
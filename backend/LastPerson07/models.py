@@ -1,25 +1,58 @@
 from datetime import datetime
-from typing import Optional, List, Dict, Any
-from pydantic import BaseModel, Field
+from functools import cached_property
+from typing import Optional, List, Dict, Any, Tuple
+from pydantic import BaseModel, ConfigDict, Field, model_validator
+from pydantic_core import core_schema
 from bson import ObjectId
+from bson.errors import InvalidId
+
+
+_utcnow = datetime.utcnow
+
+DEFAULT_CHAT_EMOJIS = ("❤️", "🔥", "👍")
+DEFAULT_BOT_EMOJIS = ("❤️", "🔥", "👍", "😍", "✨")
+
+# Message kinds a chat can opt out of reacting to
+REACT_TEXT = 1
+REACT_MEDIA = 2
+REACT_FORWARD = 4
+
+
+def _time_parts(moment: datetime) -> Dict[str, Any]:
+    """Split a timestamp into the fields stored on analytics records"""
+    return {"timestamp": moment, "date": moment.strftime("%Y-%m-%d"), "hour": moment.hour}
+
+
+def to_bson(model: BaseModel) -> Dict[str, Any]:
+    """Dump a model straight to a Motor-ready document, without a JSON roundtrip"""
+    return model.model_dump(mode="python", by_alias=True, exclude_none=True)
 
 
 class PyObjectId(ObjectId):
     """Custom ObjectId type for Pydantic"""
     
     @classmethod
-    def __get_validators__(cls):
-        yield cls.validate
+    def __get_pydantic_core_schema__(cls, source_type, handler):
+        return core_schema.no_info_plain_validator_function(
+            cls.validate,
+            serialization=core_schema.plain_serializer_function_ser_schema(
+                str,
+                when_used="json",
+            ),
+        )
     
     @classmethod
     def validate(cls, v):
-        if not ObjectId.is_valid(v):
+        if isinstance(v, ObjectId):
+            return v
+        try:
+            return ObjectId(v)
+        except (InvalidId, TypeError):
             raise ValueError("Invalid ObjectId")
-        return ObjectId(v)
     
     @classmethod
-    def __modify_schema__(cls, field_schema):
-        field_schema.update(type="string")
+    def __get_pydantic_json_schema__(cls, schema, handler):
+        return {"type": "string"}
 
 
 class UserBase(BaseModel):
@@ -40,13 +73,14 @@ class UserInDB(UserBase):
     """User database model"""
     id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
     hashed_password: str
-    created_at: datetime = Field(default_factory=datetime.utcnow)
-    updated_at: datetime = Field(default_factory=datetime.utcnow)
+    created_at: datetime = Field(default_factory=_utcnow)
+    updated_at: datetime = Field(default_factory=_utcnow)
     last_login: Optional[datetime] = None
     
-    class Config:
-        arbitrary_types_allowed = True
-        json_encoders = {ObjectId: str}
+    model_config = ConfigDict(
+        arbitrary_types_allowed=True,
+        populate_by_name=True,
+    )
 
 
 class UserResponse(BaseModel):
@@ -59,6 +93,8 @@ class UserResponse(BaseModel):
     status: str
     created_at: datetime
     last_login: Optional[datetime] = None
+    
+    model_config = ConfigDict(frozen=True)
 
 
 class TokenResponse(BaseModel):
@@ -67,6 +103,8 @@ class TokenResponse(BaseModel):
     refresh_token: str
     token_type: str = "bearer"
     expires_in: int
+    
+    model_config = ConfigDict(frozen=True)
 
 
 class LoginRequest(BaseModel):
@@ -82,14 +120,23 @@ class ChatConfig(BaseModel):
     chat_type: str
     enabled: bool = True
     reaction_mode: str = "random"
-    emojis: List[str] = ["❤️", "🔥", "👍"]
+    emojis: Tuple[str, ...] = DEFAULT_CHAT_EMOJIS
     delay_min: int = 1
     delay_max: int = 5
     react_to_media: bool = True
     react_to_text: bool = True
     react_to_forwards: bool = False
-    added_at: datetime = Field(default_factory=datetime.utcnow)
+    added_at: datetime = Field(default_factory=_utcnow)
     added_by: str
+    
+    @cached_property
+    def react_mask(self) -> int:
+        """Bitmask of the message kinds this chat reacts to"""
+        return (
+            (REACT_TEXT if self.react_to_text else 0)
+            | (REACT_MEDIA if self.react_to_media else 0)
+            | (REACT_FORWARD if self.react_to_forwards else 0)
+        )
 
 
 class ReactionRecord(BaseModel):
@@ -97,7 +144,7 @@ class ReactionRecord(BaseModel):
     chat_id: int
     message_id: int
     emoji: str
-    timestamp: datetime = Field(default_factory=datetime.utcnow)
+    timestamp: datetime = Field(default_factory=_utcnow)
     user_id: Optional[str] = None
     status: str = "success"
     error: Optional[str] = None
@@ -108,16 +155,27 @@ class AnalyticsRecord(BaseModel):
     """Analytics record model"""
     metric_type: str
     value: float
-    timestamp: datetime = Field(default_factory=datetime.utcnow)
-    date: str = Field(default_factory=lambda: datetime.utcnow().strftime("%Y-%m-%d"))
-    hour: int = Field(default_factory=lambda: datetime.utcnow().hour)
+    timestamp: datetime = Field(default_factory=_utcnow)
+    date: str = Field(default_factory=lambda: _utcnow().strftime("%Y-%m-%d"))
+    hour: int = Field(default_factory=lambda: _utcnow().hour)
     metadata: Optional[Dict[str, Any]] = None
+    
+    @model_validator(mode="before")
+    @classmethod
+    def fill_time_parts(cls, data: Any) -> Any:
+        """Derive timestamp/date/hour from a single clock read"""
+        if isinstance(data, dict) and not {"timestamp", "date", "hour"} <= data.keys():
+            moment = data.get("timestamp")
+            if not isinstance(moment, datetime):
+                moment = _utcnow()
+            data = {**_time_parts(moment), **data}
+        return data
 
 
 class BotSettings(BaseModel):
     """Bot settings model"""
     auto_react: bool = True
-    default_emojis: List[str] = ["❤️", "🔥", "👍", "😍", "✨"]
+    default_emojis: Tuple[str, ...] = DEFAULT_BOT_EMOJIS
     default_delay_min: int = 1
     default_delay_max: int = 5
     max_retries: int = 3
@@ -131,7 +189,9 @@ class WebSocketMessage(BaseModel):
     """WebSocket message model"""
     type: str
     data: Dict[str, Any]
-    timestamp: datetime = Field(default_factory=datetime.utcnow)
+    timestamp: datetime = Field(default_factory=_utcnow)
+    
+    model_config = ConfigDict(frozen=True)
 
 
 class StatsResponse(BaseModel):
@@ -144,6 +204,8 @@ class StatsResponse(BaseModel):
     error_rate: float
     emoji_usage: Dict[str, int]
     hourly_stats: List[Dict[str, Any]]
+    
+    model_config = ConfigDict(frozen=True)
 
 
 class HealthResponse(BaseModel):
@@ -154,6 +216,9 @@ class HealthResponse(BaseModel):
     redis: bool
     telegram: bool
     uptime: int
+    latency_ms: Dict[str, float] = {}
+    
+    model_config = ConfigDict(frozen=True)
 
 
 class WallpaperResponse(BaseModel):
@@ -161,3 +226,5 @@ class WallpaperResponse(BaseModel):
     url: str
     cached: bool = False
     source: str = "primary"
+    
+    model_config = ConfigDict(frozen=True)
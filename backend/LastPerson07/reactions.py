@@ -1,16 +1,51 @@
 import asyncio
 import random
 from datetime import datetime, timedelta
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict
 import os
+import httpx
 from pyrogram import Client, filters, idle
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 from pyrogram.errors import FloodWait, RPCError
 from LastPerson07.config import settings
-from LastPerson07.database import db
+from LastPerson07.database import config_cache, db
 from LastPerson07.logger import logger
-from LastPerson07.utils import exponential_backoff
+from LastPerson07.models import ChatConfig, REACT_FORWARD, REACT_MEDIA, REACT_TEXT
+from LastPerson07.utils import TokenBucket, exponential_backoff
 from LastPerson07.auth import auth_manager
+
+
+SEND_WORKERS = 4
+MAX_SEND_RETRIES = 3
+FLOOD_WAIT_PADDING = 0.1
+
+# Kept just under Telegram's limits of 30 requests/s per bot and
+# 20 messages/min per group.
+GLOBAL_SEND_RATE = 28
+CHAT_SEND_RATE = 18
+CHAT_SEND_PERIOD = 60.0
+MAX_TRACKED_CHATS = 10000
+
+HTTP_TIMEOUT = 10
+HTTP_MAX_CONNECTIONS = 20
+HTTP_MAX_KEEPALIVE = 10
+
+EMOJI_POSITION_SYNC_EVERY = 25
+EMOJI_POSITIONS_COLLECTION = "emoji_positions"
+
+WALLPAPER_CACHE_KEY = "wallpaper_current"
+DEFAULT_WALLPAPER_URL = "https://i.imgur.com/rYZ5GbL.jpg"
+
+
+def _message_mask(message: Message) -> int:
+    """Bitmask of the kinds a message belongs to, matching ChatConfig.react_mask"""
+    return (
+        (REACT_TEXT if message.text else 0)
+        | (REACT_MEDIA if message.photo or message.video or message.document else 0)
+        | (REACT_FORWARD if message.forward_date else 0)
+    )
+
+
 class TelegramBot:
     """Production-grade Telegram reaction bot"""
    
@@ -22,11 +57,26 @@ class TelegramBot:
             "total_reactions": 0,
             "flood_waits": 0,
             "errors": 0,
-            "active_chats": set(),
         }
+        self.emoji_positions: Dict[int, int] = {}
+        self.send_queue: Optional[asyncio.Queue] = None
+        self.retry_after: Optional[asyncio.Event] = None
+        self.send_workers: List[asyncio.Task] = []
+        self.global_limit = TokenBucket(GLOBAL_SEND_RATE)
+        self.chat_limits: Dict[int, TokenBucket] = {}
+        self.http = None
+        self.wallpaper_refresh: Optional[asyncio.Task] = None
    
     async def initialize(self):
         """Initialize Pyrogram client"""
+        self.http = httpx.AsyncClient(
+            timeout=HTTP_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            ),
+        )
+       
         self.app = Client(
             name=settings.TELEGRAM_SESSION_NAME,
             api_id=settings.TELEGRAM_API_ID,
@@ -42,16 +92,33 @@ class TelegramBot:
        
         logger.info("Telegram bot started successfully")
        
+        self.send_queue = asyncio.Queue()
+        self.retry_after = asyncio.Event()
+        self.retry_after.set()
+        self.send_workers = [
+            asyncio.create_task(self._sender_worker())
+            for _ in range(SEND_WORKERS)
+        ]
+       
         await self._create_owner_account()
        
         self._register_handlers()
    
     async def stop(self):
         """Stop the bot"""
+        for worker in self.send_workers:
+            worker.cancel()
+        await asyncio.gather(*self.send_workers, return_exceptions=True)
+        self.send_workers = []
+       
         if self.app:
             await self.app.stop()
             self.is_running = False
             logger.info("Telegram bot stopped")
+       
+        if self.http:
+            await self.http.aclose()
+            self.http = None
    
     async def _create_owner_account(self):
         """Create owner account if it doesn't exist"""
@@ -229,16 +296,16 @@ class TelegramBot:
                 await message.reply_text("✅ No pending users.")
                 return
            
-            text = "**📋 Pending Users:**\n\n"
+            parts = ["**📋 Pending Users:**\n\n"]
            
             for user in pending_users:
-                text += f"• **{user['username']}**\n"
-                text += f" Created: {user['created_at'].strftime('%Y-%m-%d %H:%M')}\n"
+                parts.append(f"• **{user['username']}**\n")
+                parts.append(f" Created: {user['created_at'].strftime('%Y-%m-%d %H:%M')}\n")
                 if user.get('telegram_id'):
-                    text += f" Telegram ID: `{user['telegram_id']}`\n"
-                text += f" Approve: `/approve {user['username']}`\n\n"
+                    parts.append(f" Telegram ID: `{user['telegram_id']}`\n")
+                parts.append(f" Approve: `/approve {user['username']}`\n\n")
            
-            await message.reply_text(text)
+            await message.reply_text("".join(parts))
        
         except Exception as e:
             await message.reply_text(f"❌ Error: {str(e)}")
@@ -254,7 +321,7 @@ class TelegramBot:
                 f"**📊 Bot Statistics**\n\n"
                 f"**Uptime:** {uptime_str}\n"
                 f"**Total Reactions:** {self.stats['total_reactions']}\n"
-                f"**Active Chats:** {len(self.stats['active_chats'])}\n"
+                f"**Active Chats:** {len(self.chat_limits)}\n"
                 f"**Flood Waits:** {self.stats['flood_waits']}\n"
                 f"**Errors:** {self.stats['errors']}\n\n"
                 f"_View detailed analytics on the dashboard_"
@@ -269,98 +336,130 @@ class TelegramBot:
     async def _handle_reaction(self, message: Message):
         """Handle automatic reactions"""
         try:
-            chat_config = await db.get_collection("chats").find_one({"chat_id": message.chat.id})
-           
-            if not chat_config or not chat_config.get("enabled", True):
-                return
-           
-            settings_doc = await db.get_collection("settings").find_one({"key": "bot_settings"})
-            if settings_doc and not settings_doc.get("value", {}).get("auto_react", True):
-                return
+            chat_config = await config_cache.get_chat(message.chat.id)
            
-            if not chat_config.get("react_to_text", True) and message.text:
+            if chat_config is None or not chat_config.enabled:
                 return
            
-            if not chat_config.get("react_to_media", True) and (message.photo or message.video or message.document):
+            bot_settings = await config_cache.get_bot_settings()
+            if not bot_settings.auto_react:
                 return
            
-            if not chat_config.get("react_to_forwards", False) and message.forward_date:
+            if _message_mask(message) & ~chat_config.react_mask:
                 return
            
-            delay_min = chat_config.get("delay_min", 1)
-            delay_max = chat_config.get("delay_max", 5)
-            await asyncio.sleep(random.uniform(delay_min, delay_max))
-           
             emoji = await self._select_emoji(chat_config)
            
-            await self._send_reaction(message, emoji, chat_config)
+            # Schedule the send on the loop's timer heap instead of sleeping here,
+            # so neither a task nor the Message object lives through the delay.
+            asyncio.get_running_loop().call_later(
+                random.uniform(chat_config.delay_min, chat_config.delay_max),
+                self.send_queue.put_nowait,
+                (message.chat.id, message.id, emoji, 0),
+            )
        
         except Exception as e:
             logger.error(f"Reaction handler error: {str(e)}")
             self.stats["errors"] += 1
    
-    async def _select_emoji(self, chat_config: Dict[str, Any]) -> str:
+    async def _select_emoji(self, chat_config: ChatConfig) -> str:
         """Select emoji based on configuration"""
-        mode = chat_config.get("reaction_mode", "random")
-        emojis = chat_config.get("emojis", ["❤️", "🔥", "👍"])
+        mode = chat_config.reaction_mode
+        emojis = chat_config.emojis
        
         if mode == "random":
             return random.choice(emojis)
         elif mode == "fixed":
             return emojis[0] if emojis else "❤️"
         elif mode == "sequential":
-            last_emoji_idx = chat_config.get("last_emoji_idx", 0)
-            emoji = emojis[last_emoji_idx % len(emojis)]
+            # The position lives in memory; Mongo only gets a periodic snapshot
+            # instead of a write per reaction, which seeds it after a restart.
+            # It is kept out of the chats collection so these writes do not
+            # trigger config cache invalidation.
+            position = self.emoji_positions.get(chat_config.chat_id)
+            if position is None:
+                doc = await db.get_collection(EMOJI_POSITIONS_COLLECTION).find_one(
+                    {"chat_id": chat_config.chat_id}, {"_id": 0, "position": 1}
+                )
+                position = self.emoji_positions.setdefault(
+                    chat_config.chat_id, doc["position"] if doc else 0
+                )
+            emoji = emojis[position % len(emojis)]
+            position = self.emoji_positions[chat_config.chat_id] = position + 1
            
-            await db.get_collection("chats").update_one(
-                {"chat_id": chat_config["chat_id"]},
-                {"$set": {"last_emoji_idx": (last_emoji_idx + 1) % len(emojis)}}
-            )
+            if position % EMOJI_POSITION_SYNC_EVERY == 0:
+                await db.get_collection(EMOJI_POSITIONS_COLLECTION).update_one(
+                    {"chat_id": chat_config.chat_id},
+                    {"$set": {"position": position % len(emojis)}},
+                    upsert=True
+                )
            
             return emoji
        
         return "❤️"
    
+    async def _sender_worker(self):
+        """Send queued reactions, pausing while a FloodWait is in effect"""
+        while True:
+            item = await self.send_queue.get()
+           
+            try:
+                chat_limit = self.chat_limits.get(item[0])
+                if chat_limit is None:
+                    # Buckets double as the active-chat set, so keep them bounded
+                    if len(self.chat_limits) >= MAX_TRACKED_CHATS:
+                        self.chat_limits.pop(next(iter(self.chat_limits)))
+                    chat_limit = self.chat_limits[item[0]] = TokenBucket(CHAT_SEND_RATE, CHAT_SEND_PERIOD)
+               
+                # A saturated chat is re-queued later rather than holding a worker
+                delay = chat_limit.try_acquire()
+                if delay:
+                    asyncio.get_running_loop().call_later(delay, self.send_queue.put_nowait, item)
+                    continue
+               
+                await self.retry_after.wait()
+                await self.global_limit.acquire()
+                await self._send_reaction(*item)
+            finally:
+                self.send_queue.task_done()
+   
     async def _send_reaction(
         self,
-        message: Message,
+        chat_id: int,
+        message_id: int,
         emoji: str,
-        chat_config: Dict[str, Any],
         attempt: int = 0,
     ):
-        """Send reaction with retry logic"""
-        max_retries = 3
-       
+        """Send a single reaction, re-queueing it on retryable errors"""
         try:
             await self.app.send_reaction(
-                chat_id=message.chat.id,
-                message_id=message.id,
+                chat_id=chat_id,
+                message_id=message_id,
                 emoji=emoji,
             )
            
             self.stats["total_reactions"] += 1
-            self.stats["active_chats"].add(message.chat.id)
            
-            await db.get_collection("reactions").insert_one({
-                "chat_id": message.chat.id,
-                "message_id": message.id,
+            db.enqueue_reaction({
+                "chat_id": chat_id,
+                "message_id": message_id,
                 "emoji": emoji,
                 "timestamp": datetime.utcnow(),
                 "status": "success",
                 "retry_count": attempt,
             })
            
-            await self._update_analytics("reaction_sent", 1, {"emoji": emoji})
+            self._update_analytics("reaction_sent", 1, {"emoji": emoji})
        
         except FloodWait as e:
             self.stats["flood_waits"] += 1
             wait_time = e.value
            
-            logger.warning(f"FloodWait: {wait_time}s for chat {message.chat.id}")
+            logger.warning(f"FloodWait: {wait_time}s for chat {chat_id}")
            
-            await db.get_collection("reactions").insert_one({
-                "chat_id": message.chat.id,
-                "message_id": message.id,
+            db.enqueue_reaction({
+                "chat_id": chat_id,
+                "message_id": message_id,
                 "emoji": emoji,
                 "timestamp": datetime.utcnow(),
                 "status": "flood_wait",
@@ -368,18 +467,26 @@ class TelegramBot:
                 "retry_count": attempt,
             })
            
-            if attempt < max_retries:
-                await asyncio.sleep(wait_time * 1.5)
-                await self._send_reaction(message, emoji, chat_config, attempt + 1)
+            if attempt < MAX_SEND_RETRIES:
+                self.send_queue.put_nowait((chat_id, message_id, emoji, attempt + 1))
+           
+            # FloodWait applies to the whole bot, so every worker backs off
+            # together instead of each chat sleeping on its own.
+            if self.retry_after.is_set():
+                self.retry_after.clear()
+                try:
+                    await asyncio.sleep(wait_time + FLOOD_WAIT_PADDING)
+                finally:
+                    self.retry_after.set()
        
         except RPCError as e:
             self.stats["errors"] += 1
            
-            logger.error(f"RPC Error: {str(e)} for chat {message.chat.id}")
+            logger.error(f"RPC Error: {str(e)} for chat {chat_id}")
            
-            await db.get_collection("reactions").insert_one({
-                "chat_id": message.chat.id,
-                "message_id": message.id,
+            db.enqueue_reaction({
+                "chat_id": chat_id,
+                "message_id": message_id,
                 "emoji": emoji,
                 "timestamp": datetime.utcnow(),
                 "status": "error",
@@ -387,69 +494,78 @@ class TelegramBot:
                 "retry_count": attempt,
             })
            
-            if attempt < max_retries and "FLOOD" not in str(e).upper():
-                delay = exponential_backoff(attempt)
-                await asyncio.sleep(delay)
-                await self._send_reaction(message, emoji, chat_config, attempt + 1)
+            if attempt < MAX_SEND_RETRIES and "FLOOD" not in str(e).upper():
+                asyncio.get_running_loop().call_later(
+                    exponential_backoff(attempt),
+                    self.send_queue.put_nowait,
+                    (chat_id, message_id, emoji, attempt + 1),
+                )
        
         except Exception as e:
             self.stats["errors"] += 1
             logger.error(f"Unexpected error in send_reaction: {str(e)}")
    
     async def _get_wallpaper(self) -> str:
-        """Get wallpaper from MongoDB cache or API"""
+        """Get wallpaper from MongoDB cache, refreshing it in the background once stale"""
         try:
-            import httpx
-           
-            cache_key = "wallpaper_current"
-            cached = await db.get_collection("cache").find_one({"key": cache_key})
+            cached = await db.get_collection("cache").find_one({"key": WALLPAPER_CACHE_KEY})
            
-            if cached and cached.get("expires_at") > datetime.utcnow():
+            if cached:
+                if cached.get("expires_at") <= datetime.utcnow():
+                    self._schedule_wallpaper_refresh()
                 return cached["value"]
            
-            async with httpx.AsyncClient() as client:
-                try:
-                    response = await client.get(settings.WALLPAPER_API_PRIMARY, timeout=10)
-                    response.raise_for_status()
-                    data = response.json()
-                    url = data["results"][0]["url"]
-                except Exception:
-                    response = await client.get(settings.WALLPAPER_API_FALLBACK, timeout=10)
-                    response.raise_for_status()
-                    data = response.json()
-                    url = data["url"]
-               
-                await db.get_collection("cache").update_one(
-                    {"key": cache_key},
-                    {
-                        "$set": {
-                            "value": url,
-                            "expires_at": datetime.utcnow() + timedelta(seconds=settings.WALLPAPER_CACHE_TTL),
-                            "updated_at": datetime.utcnow(),
-                        }
-                    },
-                    upsert=True
-                )
-               
+            url = await asyncio.shield(self._schedule_wallpaper_refresh())
+            if url:
                 return url
        
         except Exception as e:
             logger.error(f"Wallpaper fetch error: {str(e)}")
-            return "https://i.imgur.com/rYZ5GbL.jpg"
+       
+        return DEFAULT_WALLPAPER_URL
+   
+    def _schedule_wallpaper_refresh(self) -> asyncio.Task:
+        """Start a wallpaper refresh unless one is already in flight"""
+        if self.wallpaper_refresh is None or self.wallpaper_refresh.done():
+            self.wallpaper_refresh = asyncio.create_task(self._refresh_wallpaper())
+        return self.wallpaper_refresh
    
-    async def _update_analytics(self, metric_type: str, value: float, metadata: Optional[Dict] = None):
-        """Update analytics data"""
+    async def _refresh_wallpaper(self) -> Optional[str]:
+        """Fetch a new wallpaper URL from the API and store it in the MongoDB cache"""
         try:
-            now = datetime.utcnow()
-           
-            await db.get_collection("analytics").insert_one({
-                "metric_type": metric_type,
-                "value": value,
-                "timestamp": now,
-                "date": now.strftime("%Y-%m-%d"),
-                "hour": now.hour,
-                "metadata": metadata or {},
-            })
+            try:
+                response = await self.http.get(settings.WALLPAPER_API_PRIMARY)
+                response.raise_for_status()
+                data = response.json()
+                url = data["results"][0]["url"]
+            except Exception:
+                response = await self.http.get(settings.WALLPAPER_API_FALLBACK)
+                response.raise_for_status()
+                data = response.json()
+                url = data["url"]
+           
+            await db.get_collection("cache").update_one(
+                {"key": WALLPAPER_CACHE_KEY},
+                {
+                    "$set": {
+                        "value": url,
+                        "expires_at": datetime.utcnow() + timedelta(seconds=settings.WALLPAPER_CACHE_TTL),
+                        "updated_at": datetime.utcnow(),
+                    }
+                },
+                upsert=True
+            )
+           
+            return url
+       
+        except Exception as e:
+            logger.error(f"Wallpaper refresh error: {str(e)}")
+            return None
+   
+    def _update_analytics(self, metric_type: str, value: float, metadata: Optional[Dict] = None):
+        """Add to the hourly analytics rollup"""
+        try:
+            db.increment_analytics(metric_type, value, metadata)
         except Exception as e:
             logger.error(f"Analytics update error: {str(e)}")
    
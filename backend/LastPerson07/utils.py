@@ -1,16 +1,55 @@
+import asyncio
 import hashlib
+import random
+import re
 import secrets
 import time
 from datetime import datetime, timedelta
 from typing import Optional, Dict, Any
-from jose import JWTError, jwt
+import jwt
+from jwt import InvalidTokenError
 from passlib.context import CryptContext
 from fastapi import HTTPException, status
+from LastPerson07.cache import TTLCache
 from LastPerson07.config import settings
 
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+JWT_CACHE_TTL = 30
+JWT_CACHE_MAX_SIZE = 10000
+
+# Dedicated bounded cache so one-off tokens cannot crowd out other entries
+_jwt_cache = TTLCache(maxsize=JWT_CACHE_MAX_SIZE)
+
+_SANITIZE_TABLE = str.maketrans(
+    "", "", "".join(map(chr, range(32))) + "<>&\"'`/\\{};"
+)
+
+_EMOJI_RE = re.compile(
+    "["
+    "\U0001F600-\U0001F64F"
+    "\U0001F300-\U0001F5FF"
+    "\U0001F680-\U0001F6FF"
+    "\U0001F1E0-\U0001F1FF"
+    "\U00002702-\U000027B0"
+    "\U000024C2-\U0001F251"
+    "]+",
+    flags=re.UNICODE
+)
+
+_EMOJI_CATEGORIES = {
+    "positive": ("❤️", "😍", "😊", "🥰", "😘", "🤗", "👍", "🔥", "✨", "💯", "🎉", "🌟"),
+    "negative": ("😢", "😭", "😡", "😠", "💔", "👎", "😞", "😔", "🤬"),
+    "neutral": ("👀", "🤔", "😐", "😑", "🙄"),
+    "reactions": ("😂", "🤣", "😱", "😮", "🤯", "😎", "🤓", "🧐"),
+}
+_EMOJI_CATEGORY = {
+    emoji: category
+    for category, emojis in _EMOJI_CATEGORIES.items()
+    for emoji in emojis
+}
+
 
 def hash_password(password: str) -> str:
     """Hash a password using bcrypt"""
@@ -22,6 +61,16 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
 
+async def ahash_password(password: str) -> str:
+    """Hash a password in a worker thread so bcrypt does not block the event loop"""
+    return await asyncio.to_thread(pwd_context.hash, password)
+
+
+async def averify_password(plain_password: str, hashed_password: str) -> bool:
+    """Verify a password in a worker thread so bcrypt does not block the event loop"""
+    return await asyncio.to_thread(pwd_context.verify, plain_password, hashed_password)
+
+
 def generate_secure_token(length: int = 32) -> str:
     """Generate a secure random token"""
     return secrets.token_urlsafe(length)
@@ -62,16 +111,28 @@ def create_refresh_token(data: Dict[str, Any]) -> str:
 
 
 def decode_token(token: str) -> Dict[str, Any]:
-    """Decode and verify a JWT token"""
+    """Decode and verify a JWT token, reusing recent results for the same token"""
+    cache_key = f"jwt:{hashlib.blake2b(token.encode(), digest_size=16).hexdigest()}"
+    payload = _jwt_cache.get(cache_key)
+    
+    if payload is not None:
+        return payload
+    
     try:
         payload = jwt.decode(token, settings.JWT_SECRET, algorithms=[settings.JWT_ALGORITHM])
-        return payload
-    except JWTError as e:
+    except InvalidTokenError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid authentication credentials",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    
+    # Never serve a cached payload past the token's own expiry
+    ttl = min(JWT_CACHE_TTL, payload.get("exp", float("inf")) - time.time())
+    if ttl > 0:
+        _jwt_cache.set(cache_key, payload, ttl)
+    
+    return payload
 
 
 def sanitize_input(text: str, max_length: int = 500) -> str:
@@ -79,13 +140,7 @@ def sanitize_input(text: str, max_length: int = 500) -> str:
     if not text:
         return ""
     
-    text = text.strip()[:max_length]
-    
-    dangerous_chars = ["<", ">", "&", '"', "'", "/", "\\", "{", "}", ";"]
-    for char in dangerous_chars:
-        text = text.replace(char, "")
-    
-    return text
+    return text.strip()[:max_length].translate(_SANITIZE_TABLE)
 
 
 def validate_telegram_id(telegram_id: int) -> bool:
@@ -105,16 +160,43 @@ def generate_api_key() -> str:
 
 def hash_api_key(api_key: str) -> str:
     """Hash an API key for storage"""
-    return hashlib.sha256(api_key.encode()).hexdigest()
+    return hashlib.blake2b(api_key.encode(), digest_size=32).hexdigest()
 
 
 def exponential_backoff(attempt: int, base_delay: float = 1.0, max_delay: float = 60.0) -> float:
     """Calculate exponential backoff delay"""
     delay = min(base_delay * (2 ** attempt), max_delay)
-    jitter = secrets.randbelow(1000) / 1000.0
+    jitter = random.random()
     return delay + jitter
 
 
+class TokenBucket:
+    """In-process token bucket allowing `rate` acquisitions per `period` seconds"""
+    
+    def __init__(self, rate: float, period: float = 1.0):
+        self.capacity = rate
+        self.fill_rate = rate / period
+        self.tokens = rate
+        self.updated_at = time.monotonic()
+    
+    def try_acquire(self) -> float:
+        """Take a token if one is available, otherwise return seconds until one is"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.fill_rate)
+        self.updated_at = now
+        
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        
+        return (1 - self.tokens) / self.fill_rate
+    
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        while delay := self.try_acquire():
+            await asyncio.sleep(delay)
+
+
 async def rate_limit_check(redis_client, key: str, limit: int, window: int) -> bool:
     """
     Check rate limit using sliding window algorithm
@@ -163,32 +245,9 @@ def format_duration(seconds: int) -> str:
 
 def get_emoji_category(emoji: str) -> str:
     """Categorize emoji into groups"""
-    emoji_categories = {
-        "positive": ["❤️", "😍", "😊", "🥰", "😘", "🤗", "👍", "🔥", "✨", "💯", "🎉", "🌟"],
-        "negative": ["😢", "😭", "😡", "😠", "💔", "👎", "😞", "😔", "🤬"],
-        "neutral": ["👀", "🤔", "😐", "😑", "🙄"],
-        "reactions": ["😂", "🤣", "😱", "😮", "🤯", "😎", "🤓", "🧐"],
-    }
-    
-    for category, emojis in emoji_categories.items():
-        if emoji in emojis:
-            return category
-    
-    return "other"
+    return _EMOJI_CATEGORY.get(emoji, "other")
 
 
 def validate_emoji(emoji: str) -> bool:
     """Validate if string is a valid emoji"""
-    import re
-    emoji_pattern = re.compile(
-        "["
-        "\U0001F600-\U0001F64F"
-        "\U0001F300-\U0001F5FF"
-        "\U0001F680-\U0001F6FF"
-        "\U0001F1E0-\U0001F1FF"
-        "\U00002702-\U000027B0"
-        "\U000024C2-\U0001F251"
-        "]+",
-        flags=re.UNICODE
-    )
-    return bool(emoji_pattern.match(emoji))
+    return bool(_EMOJI_RE.match(emoji))
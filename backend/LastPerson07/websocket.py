@@ -1,25 +1,78 @@
 import asyncio
-import json
+import itertools
+import time
+import zlib
 from datetime import datetime
-from typing import Dict, Set
-from fastapi import WebSocket, WebSocketDisconnect
-from LastPerson07.config import settings
+from typing import Dict, Iterable, Optional, Set, Tuple, Union
+import orjson
+from fastapi import WebSocket
+from pymongo import CursorType
+from LastPerson07.database import db, INSTANCE_ID, WS_EVENTS_COLLECTION
 from LastPerson07.logger import logger
 from LastPerson07.analytics import analytics_engine
 from LastPerson07.reactions import telegram_bot
 
 
+# Clients opt in with {"type": "subscribe", "room": "admin:chats"}
+CHATS_ROOM = "admin:chats"
+
+# Naive UTC datetimes keep the same ISO format as the HTTP responses
+WS_JSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+OUTBOX_SIZE = 32
+SLOW_CLIENT_CLOSE_CODE = 1013
+COMPRESSION_LEVEL = 1
+
+# Envelope templates, copied per emit instead of rebuilding the literal
+INITIAL_STATS_FRAME = {"type": "initial_stats", "data": None, "timestamp": None}
+STATS_UPDATE_FRAME = {"type": "stats_update", "data": None, "timestamp": None}
+REACTION_FRAME = {"type": "reaction", "data": None, "timestamp": None}
+CHAT_ADDED_FRAME = {"type": "chat_added", "data": None, "timestamp": None}
+CHAT_UPDATED_FRAME = {"type": "chat_updated", "data": None, "timestamp": None}
+CHAT_DELETED_FRAME = {"type": "chat_deleted", "data": None, "timestamp": None}
+ERROR_FRAME = {"type": "error", "data": None, "timestamp": None}
+
+STATS_CACHE_SECONDS = 5
+PERSISTED_STATS_SECONDS = 60
+STATS_QUERY_FIELDS = (
+    "total_reactions",
+    "reactions_per_second",
+    "active_chats",
+    "flood_waits",
+    "error_rate",
+    "emoji_usage",
+    "hourly_stats",
+)
+
+
 class WebSocketManager:
     """Production-grade WebSocket manager with in-memory broadcasting"""
     
     def __init__(self):
-        self.active_connections: Set[WebSocket] = set()
+        # Connections are keyed by small integer ids so fan-out walks plain
+        # dicts of outboxes instead of hashing WebSocket objects per send
+        self.connections: Dict[int, WebSocket] = {}
+        self.connection_ids: Dict[WebSocket, int] = {}
+        self.outboxes: Dict[int, asyncio.Queue] = {}
+        self.writers: Dict[int, asyncio.Task] = {}
+        self.rooms: Dict[str, Set[int]] = {}
+        self.subscriptions: Dict[int, Set[str]] = {}
+        self.compressed_connections: Set[int] = set()
+        self.next_connection_id = itertools.count(1)
+        self.has_clients = asyncio.Event()
         self.broadcast_task = None
+        self.backplane_task = None
+        self.instance_id = INSTANCE_ID
+        self.stats_cache: Optional[Tuple[int, Dict]] = None
+        self.stats_refresh: Optional[asyncio.Task] = None
+        self.persisted_stats: Optional[Tuple[int, Dict]] = None
+        self.background_tasks: Set[asyncio.Task] = set()
     
     async def initialize(self):
         """Initialize WebSocket manager"""
         try:
             self.broadcast_task = asyncio.create_task(self._broadcast_stats_loop())
+            self.backplane_task = asyncio.create_task(self._backplane_loop())
             
             logger.info("WebSocket manager initialized (MongoDB-only mode)")
         except Exception as e:
@@ -31,6 +84,9 @@ class WebSocketManager:
             if self.broadcast_task:
                 self.broadcast_task.cancel()
             
+            if self.backplane_task:
+                self.backplane_task.cancel()
+            
             logger.info("WebSocket manager closed")
         except Exception as e:
             logger.error(f"WebSocket manager close error: {str(e)}")
@@ -38,98 +94,339 @@ class WebSocketManager:
     async def connect(self, websocket: WebSocket):
         """Connect a new WebSocket client"""
         await websocket.accept()
-        self.active_connections.add(websocket)
         
-        logger.info(f"WebSocket client connected. Total connections: {len(self.active_connections)}")
+        connection_id = next(self.next_connection_id)
+        self.connections[connection_id] = websocket
+        self.connection_ids[websocket] = connection_id
+        self.has_clients.set()
+        
+        outbox = self.outboxes[connection_id] = asyncio.Queue(maxsize=OUTBOX_SIZE)
+        self.writers[connection_id] = asyncio.create_task(
+            self._writer_loop(connection_id, websocket, outbox)
+        )
         
-        await self._send_initial_data(websocket)
+        logger.info(f"WebSocket client connected. Total connections: {len(self.connections)}")
+        
+        await self._send_initial_data(connection_id)
     
     def disconnect(self, websocket: WebSocket):
         """Disconnect a WebSocket client"""
-        self.active_connections.discard(websocket)
-        logger.info(f"WebSocket client disconnected. Total connections: {len(self.active_connections)}")
+        connection_id = self.connection_ids.pop(websocket, None)
+        if connection_id is None:
+            return
+        
+        self._drop(connection_id)
     
-    async def _send_initial_data(self, websocket: WebSocket):
+    def _drop(self, connection_id: int):
+        """Release every structure held for a connection id"""
+        websocket = self.connections.pop(connection_id, None)
+        if websocket is None:
+            return
+        
+        self.connection_ids.pop(websocket, None)
+        self.outboxes.pop(connection_id, None)
+        self.compressed_connections.discard(connection_id)
+        
+        writer = self.writers.pop(connection_id, None)
+        if writer is not None and writer is not asyncio.current_task():
+            writer.cancel()
+        
+        for room in self.subscriptions.pop(connection_id, set()):
+            self._leave(connection_id, room)
+        
+        if not self.connections:
+            self.has_clients.clear()
+        
+        logger.info(f"WebSocket client disconnected. Total connections: {len(self.connections)}")
+    
+    def subscribe(self, websocket: WebSocket, room: str):
+        """Subscribe a client to a room"""
+        connection_id = self.connection_ids.get(websocket)
+        if connection_id is not None:
+            self._join(connection_id, room)
+    
+    def unsubscribe(self, websocket: WebSocket, room: str):
+        """Unsubscribe a client from a room"""
+        connection_id = self.connection_ids.get(websocket)
+        if connection_id is not None:
+            self._leave(connection_id, room)
+    
+    def _join(self, connection_id: int, room: str):
+        """Add a connection id to a room"""
+        self.rooms.setdefault(room, set()).add(connection_id)
+        self.subscriptions.setdefault(connection_id, set()).add(room)
+    
+    def _leave(self, connection_id: int, room: str):
+        """Remove a connection id from a room"""
+        members = self.rooms.get(room)
+        if members is not None:
+            members.discard(connection_id)
+            if not members:
+                del self.rooms[room]
+        
+        self.subscriptions.get(connection_id, set()).discard(room)
+    
+    async def handle_message(self, websocket: WebSocket, data: str):
+        """Handle a client control message such as room (un)subscription"""
+        try:
+            message = orjson.loads(data)
+        except orjson.JSONDecodeError:
+            logger.debug(f"WebSocket message received: {data}")
+            return
+        
+        if not isinstance(message, dict):
+            return
+        
+        if message.get("type") == "compression":
+            self.set_compression(websocket, bool(message.get("enabled")))
+            return
+        
+        room = message.get("room")
+        if not isinstance(room, str):
+            return
+        
+        if message.get("type") == "subscribe":
+            self.subscribe(websocket, room)
+        elif message.get("type") == "unsubscribe":
+            self.unsubscribe(websocket, room)
+    
+    def set_compression(self, websocket: WebSocket, enabled: bool):
+        """Switch a client between plain text frames and zlib-compressed binary frames"""
+        connection_id = self.connection_ids.get(websocket)
+        if connection_id is None:
+            return
+        
+        if enabled:
+            self.compressed_connections.add(connection_id)
+        else:
+            self.compressed_connections.discard(connection_id)
+    
+    @staticmethod
+    def _frame(template: Dict, data) -> Dict:
+        """Fill a copy of an envelope template with data and the current time"""
+        frame = template.copy()
+        frame["data"] = data
+        frame["timestamp"] = datetime.utcnow()
+        return frame
+    
+    @staticmethod
+    def _encode(message: Dict) -> str:
+        """Encode a message once for sending as a JSON text frame"""
+        return orjson.dumps(message, option=WS_JSON_OPTIONS).decode()
+    
+    async def _send_initial_data(self, connection_id: int):
         """Send initial data to newly connected client"""
         try:
-            stats = await self._get_current_stats()
+            stats = await self.get_current_stats()
             
-            await websocket.send_json({
-                "type": "initial_stats",
-                "data": stats,
-                "timestamp": datetime.utcnow().isoformat()
-            })
+            self._enqueue((connection_id,), self._encode(self._frame(INITIAL_STATS_FRAME, stats)))
         except Exception as e:
             logger.error(f"Error sending initial data: {str(e)}")
     
     async def broadcast(self, message: Dict):
         """Broadcast message to all connected clients"""
-        disconnected = set()
+        if self.outboxes:
+            self._enqueue(self.outboxes, self._encode(message))
+    
+    async def publish(self, rooms: Iterable[str], message: Dict):
+        """Publish message to local room members and to other workers"""
+        rooms = list(rooms)
+        
+        await self._publish_local(rooms, message)
+        
+        try:
+            await db.get_collection(WS_EVENTS_COLLECTION).insert_one({
+                "origin": self.instance_id,
+                "rooms": rooms,
+                "message": message,
+            })
+        except Exception as e:
+            logger.error(f"Error publishing to backplane: {str(e)}")
+    
+    async def _publish_local(self, rooms: Iterable[str], message: Dict):
+        """Send message once to every local client subscribed to any of the rooms"""
+        recipients = set()
+        for room in rooms:
+            recipients.update(self.rooms.get(room, ()))
+        
+        if recipients:
+            self._enqueue(recipients, self._encode(message))
+    
+    def _enqueue(self, connection_ids: Iterable[int], payload: str):
+        """Queue a pre-encoded payload on each connection's outbox without waiting"""
+        outboxes = self.outboxes
+        compressing = self.compressed_connections
+        compressed = None
         
-        for connection in self.active_connections:
+        for connection_id in list(connection_ids):
+            outbox = outboxes.get(connection_id)
+            if outbox is None:
+                continue
+            
+            frame = payload
+            if compressing and connection_id in compressing:
+                # Compress once per message, not once per connection
+                if compressed is None:
+                    compressed = zlib.compress(payload.encode(), COMPRESSION_LEVEL)
+                frame = compressed
+            
             try:
-                await connection.send_json(message)
+                outbox.put_nowait(frame)
+            except asyncio.QueueFull:
+                logger.warning("Dropping WebSocket client that is not keeping up")
+                websocket = self.connections[connection_id]
+                self._drop(connection_id)
+                task = asyncio.create_task(self._close_quietly(websocket, SLOW_CLIENT_CLOSE_CODE))
+                self.background_tasks.add(task)
+                task.add_done_callback(self.background_tasks.discard)
+    
+    async def _writer_loop(self, connection_id: int, websocket: WebSocket, outbox: asyncio.Queue):
+        """Drain one connection's outbox so a slow client only delays itself"""
+        while True:
+            payload: Union[str, bytes] = await outbox.get()
+            
+            try:
+                if isinstance(payload, bytes):
+                    await websocket.send_bytes(payload)
+                else:
+                    await websocket.send_text(payload)
             except Exception as e:
-                logger.error(f"Error broadcasting to client: {str(e)}")
-                disconnected.add(connection)
-        
-        for connection in disconnected:
-            self.disconnect(connection)
+                logger.error(f"Error sending to client: {str(e)}")
+                self._drop(connection_id)
+                return
     
-    async def _get_current_stats(self) -> Dict:
-        """Get current statistics"""
+    @staticmethod
+    async def _close_quietly(websocket: WebSocket, code: int):
+        """Close a connection, ignoring errors from already-closed sockets"""
         try:
-            total_reactions = await analytics_engine.get_total_reactions()
-            reactions_per_second = await analytics_engine.get_reactions_per_second(hours=1)
-            active_chats = await analytics_engine.get_active_chats()
-            flood_waits = await analytics_engine.get_flood_waits(hours=24)
-            error_rate = await analytics_engine.get_error_rate(hours=24)
-            emoji_usage = await analytics_engine.get_emoji_usage(hours=24)
-            hourly_stats = await analytics_engine.get_hourly_stats(hours=24)
-            
-            bot_uptime = telegram_bot.get_uptime() if telegram_bot.is_running else 0
+            await websocket.close(code=code)
+        except Exception:
+            pass
+    
+    async def _backplane_loop(self):
+        """Relay room events and cache invalidations published by other workers"""
+        collection = db.get_collection(WS_EVENTS_COLLECTION)
+        last_id: Optional[object] = None
+        
+        while True:
+            try:
+                if last_id is None:
+                    latest = await collection.find_one({}, sort=[("$natural", -1)])
+                    last_id = latest["_id"] if latest else None
+                
+                query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+                cursor = collection.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+                
+                while cursor.alive:
+                    async for event in cursor:
+                        last_id = event["_id"]
+                        
+                        if event.get("origin") == self.instance_id:
+                            continue
+                        
+                        if "invalidate" in event:
+                            db.apply_invalidation(event)
+                        else:
+                            await self._publish_local(event["rooms"], event["message"])
+                    
+                    await asyncio.sleep(1)
+                
+                await asyncio.sleep(1)
             
-            return {
-                "total_reactions": total_reactions,
-                "reactions_per_second": reactions_per_second,
-                "active_chats": active_chats,
-                "bot_uptime": bot_uptime,
-                "flood_waits": flood_waits,
-                "error_rate": error_rate,
-                "emoji_usage": emoji_usage,
-                "hourly_stats": hourly_stats,
-                "timestamp": datetime.utcnow().isoformat()
-            }
-        except Exception as e:
-            logger.error(f"Error getting current stats: {str(e)}")
-            return {
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"WebSocket backplane loop error: {str(e)}")
+                await asyncio.sleep(5)
+    
+    async def get_current_stats(self) -> Dict:
+        """Get current statistics, computed at most once per 5 second window"""
+        bucket = int(time.monotonic() // STATS_CACHE_SECONDS)
+        
+        if self.stats_cache is not None and self.stats_cache[0] == bucket:
+            return self.stats_cache[1]
+        
+        # Concurrent misses wait on the same computation
+        if self.stats_refresh is None or self.stats_refresh.done():
+            self.stats_refresh = asyncio.create_task(self._get_current_stats(bucket))
+        
+        return await asyncio.shield(self.stats_refresh)
+    
+    async def _get_current_stats(self, bucket: int) -> Dict:
+        """Compute current statistics and cache them for the given window"""
+        complete = True
+        
+        # Snapshots come only from MongoDB and refresh on wall-clock minute
+        # boundaries, so every worker reports the same figures; per-process
+        # bot counters are deliberately not added on top
+        epoch = int(time.time() // PERSISTED_STATS_SECONDS)
+        persisted = self.persisted_stats
+        if persisted is None or persisted[0] != epoch:
+            base, complete = await self._query_stats()
+            if complete:
+                self.persisted_stats = (epoch, base)
+        else:
+            base = persisted[1]
+        
+        stats = dict(base)
+        stats["bot_uptime"] = telegram_bot.get_uptime() if telegram_bot.is_running else 0
+        stats["timestamp"] = datetime.utcnow()
+        
+        if complete:
+            self.stats_cache = (bucket, stats)
+        
+        return stats
+    
+    async def _query_stats(self) -> Tuple[Dict, bool]:
+        """Run the MongoDB stats queries, reporting whether every one succeeded"""
+        results = await asyncio.gather(
+            analytics_engine.get_total_reactions(),
+            analytics_engine.get_reactions_per_second(hours=1),
+            analytics_engine.get_active_chats(),
+            analytics_engine.get_flood_waits(hours=24),
+            analytics_engine.get_error_rate(hours=24),
+            analytics_engine.get_emoji_usage(hours=24),
+            analytics_engine.get_hourly_stats(hours=24),
+            return_exceptions=True,
+        )
+        
+        # A failed query keeps the last good value rather than reporting zero
+        if self.persisted_stats is not None:
+            stats = dict(self.persisted_stats[1])
+        else:
+            stats = {
                 "total_reactions": 0,
                 "reactions_per_second": 0.0,
                 "active_chats": 0,
-                "bot_uptime": 0,
                 "flood_waits": 0,
                 "error_rate": 0.0,
                 "emoji_usage": {},
                 "hourly_stats": [],
-                "timestamp": datetime.utcnow().isoformat()
             }
+        complete = True
+        
+        for field, result in zip(STATS_QUERY_FIELDS, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error getting {field} stat: {str(result)}")
+                complete = False
+            else:
+                stats[field] = result
+        
+        return stats, complete
     
     async def _broadcast_stats_loop(self):
-        """Broadcast stats every 5 seconds"""
+        """Broadcast stats every 5 seconds while any client is connected"""
         while True:
             try:
+                await self.has_clients.wait()
                 await asyncio.sleep(5)
                 
-                if not self.active_connections:
+                if not self.connections:
                     continue
                 
-                stats = await self._get_current_stats()
+                stats = await self.get_current_stats()
                 
-                await self.broadcast({
-                    "type": "stats_update",
-                    "data": stats,
-                    "timestamp": datetime.utcnow().isoformat()
-                })
+                await self.broadcast(self._frame(STATS_UPDATE_FRAME, stats))
             
             except asyncio.CancelledError:
                 break
@@ -138,50 +435,40 @@ class WebSocketManager:
     
     async def notify_reaction(self, chat_id: int, message_id: int, emoji: str, status: str):
         """Notify clients about a reaction event"""
-        await self.broadcast({
-            "type": "reaction",
-            "data": {
-                "chat_id": chat_id,
-                "message_id": message_id,
-                "emoji": emoji,
-                "status": status,
-            },
-            "timestamp": datetime.utcnow().isoformat()
-        })
+        await self.broadcast(self._frame(REACTION_FRAME, {
+            "chat_id": chat_id,
+            "message_id": message_id,
+            "emoji": emoji,
+            "status": status,
+        }))
     
     async def notify_chat_added(self, chat_id: int, chat_title: str):
         """Notify clients about a new chat being added"""
-        await self.broadcast({
-            "type": "chat_added",
-            "data": {
-                "chat_id": chat_id,
-                "chat_title": chat_title,
-            },
-            "timestamp": datetime.utcnow().isoformat()
-        })
+        await self.publish((CHATS_ROOM, f"chat:{chat_id}"), self._frame(CHAT_ADDED_FRAME, {
+            "chat_id": chat_id,
+            "chat_title": chat_title,
+        }))
     
     async def notify_chat_updated(self, chat_id: int, changes: Dict):
         """Notify clients about chat configuration changes"""
-        await self.broadcast({
-            "type": "chat_updated",
-            "data": {
-                "chat_id": chat_id,
-                "changes": changes,
-            },
-            "timestamp": datetime.utcnow().isoformat()
-        })
+        await self.publish((CHATS_ROOM, f"chat:{chat_id}"), self._frame(CHAT_UPDATED_FRAME, {
+            "chat_id": chat_id,
+            "changes": changes,
+        }))
+    
+    async def notify_chat_deleted(self, chat_id: int):
+        """Notify clients about a chat being removed"""
+        await self.publish((CHATS_ROOM, f"chat:{chat_id}"), self._frame(CHAT_DELETED_FRAME, {
+            "chat_id": chat_id,
+        }))
     
     async def notify_error(self, error_type: str, message: str, details: Dict = None):
         """Notify clients about errors"""
-        await self.broadcast({
-            "type": "error",
-            "data": {
-                "error_type": error_type,
-                "message": message,
-                "details": details or {},
-            },
-            "timestamp": datetime.utcnow().isoformat()
-        })
+        await self.broadcast(self._frame(ERROR_FRAME, {
+            "error_type": error_type,
+            "message": message,
+            "details": details or {},
+        }))
 
 
 websocket_manager = WebSocketManager()
@@ -1,9 +1,11 @@
 import asyncio
+import time
 from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
+from typing import Optional, Tuple
 from fastapi import FastAPI, Depends, HTTPException, status, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 import httpx
 from LastPerson07.config import settings
 from LastPerson07.database import db
@@ -24,13 +26,21 @@ from LastPerson07.models import (
     WallpaperResponse,
 )
 from LastPerson07.utils import (
-    verify_password,
+    averify_password,
     create_access_token,
     create_refresh_token,
     sanitize_input,
 )
 
 
+WALLPAPER_CACHE_KEY = "wallpaper_current"
+DEFAULT_WALLPAPER_URL = "https://i.imgur.com/rYZ5GbL.jpg"
+
+# Process-local copy of the wallpaper: (expires_at monotonic, url, source)
+_wallpaper_cache: Optional[Tuple[float, str, str]] = None
+_wallpaper_lock = asyncio.Lock()
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Application lifespan manager"""
@@ -39,6 +49,11 @@ async def lifespan(app: FastAPI):
     await db.connect()
     logger.info("✅ Database connected")
     
+    app.state.httpx = httpx.AsyncClient(
+        timeout=10,
+        limits=httpx.Limits(max_keepalive_connections=20),
+    )
+    
     await auth_manager.initialize()
     logger.info("✅ Auth manager initialized")
     
@@ -57,23 +72,28 @@ async def lifespan(app: FastAPI):
     await auth_manager.close()
     await db.disconnect()
     
+    await app.state.httpx.aclose()
+    
     logger.info("✅ Shutdown complete")
+    logger.stop()
 
 
 app = FastAPI(
     title="Telegram Reaction SaaS",
     description="Production-grade Telegram auto-reaction platform",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
     lifespan=lifespan,
 )
 
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=settings.cors_origins_list + ["*"],
+    allow_origins=settings.CORS_ORIGINS,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    max_age=86400,
 )
 
 
@@ -108,15 +128,16 @@ async def register(user: UserCreate):
             status="pending",
         )
         
-        return UserResponse(
-            id=result["id"],
-            username=result["username"],
-            email=user.email,
-            telegram_id=user.telegram_id,
-            role=result["role"],
-            status=result["status"],
-            created_at=datetime.utcnow(),
-        )
+        return ORJSONResponse({
+            "id": result["id"],
+            "username": result["username"],
+            "email": user.email,
+            "telegram_id": user.telegram_id,
+            "role": result["role"],
+            "status": result["status"],
+            "created_at": datetime.utcnow(),
+            "last_login": None,
+        })
     
     except HTTPException:
         raise
@@ -135,9 +156,12 @@ async def login(request: Request, login_data: LoginRequest):
     
     username = sanitize_input(login_data.username, max_length=50)
     
-    user_data = await db.get_collection("users").find_one({"username": username})
+    user_data = await db.get_collection("users").find_one(
+        {"username": username},
+        {"hashed_password": 1, "status": 1, "role": 1, "_id": 0},
+    )
     
-    if not user_data or not verify_password(login_data.password, user_data["hashed_password"]):
+    if not user_data or not await averify_password(login_data.password, user_data["hashed_password"]):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password"
@@ -152,30 +176,31 @@ async def login(request: Request, login_data: LoginRequest):
     access_token = create_access_token({"sub": username, "role": user_data["role"]})
     refresh_token = create_refresh_token({"sub": username})
     
-    await auth_manager.update_last_login(username)
+    auth_manager.record_login(username)
     
     logger.info(f"User logged in: {username}")
     
-    return TokenResponse(
-        access_token=access_token,
-        refresh_token=refresh_token,
-        expires_in=settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60,
-    )
+    return ORJSONResponse({
+        "access_token": access_token,
+        "refresh_token": refresh_token,
+        "token_type": "bearer",
+        "expires_in": settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+    })
 
 
 @app.get(f"{settings.API_PREFIX}/auth/me", response_model=UserResponse)
 async def get_current_user_info(current_user = Depends(auth_manager.get_current_user)):
     """Get current user information"""
-    return UserResponse(
-        id=str(current_user.id),
-        username=current_user.username,
-        email=current_user.email,
-        telegram_id=current_user.telegram_id,
-        role=current_user.role,
-        status=current_user.status,
-        created_at=current_user.created_at,
-        last_login=current_user.last_login,
-    )
+    return ORJSONResponse({
+        "id": str(current_user.id),
+        "username": current_user.username,
+        "email": current_user.email,
+        "telegram_id": current_user.telegram_id,
+        "role": current_user.role,
+        "status": current_user.status,
+        "created_at": current_user.created_at,
+        "last_login": current_user.last_login,
+    })
 
 
 @app.get(f"{settings.API_PREFIX}/users")
@@ -267,26 +292,9 @@ async def delete_chat(
 @app.get(f"{settings.API_PREFIX}/stats", response_model=StatsResponse)
 async def get_stats(current_user = Depends(auth_manager.get_current_user)):
     """Get comprehensive statistics"""
-    total_reactions = await analytics_engine.get_total_reactions()
-    reactions_per_second = await analytics_engine.get_reactions_per_second(hours=1)
-    active_chats = await analytics_engine.get_active_chats()
-    flood_waits = await analytics_engine.get_flood_waits(hours=24)
-    error_rate = await analytics_engine.get_error_rate(hours=24)
-    emoji_usage = await analytics_engine.get_emoji_usage(hours=24)
-    hourly_stats = await analytics_engine.get_hourly_stats(hours=24)
-    
-    bot_uptime = telegram_bot.get_uptime() if telegram_bot.is_running else 0
+    stats = await websocket_manager.get_current_stats()
     
-    return StatsResponse(
-        total_reactions=total_reactions,
-        reactions_per_second=reactions_per_second,
-        active_chats=active_chats,
-        bot_uptime=bot_uptime,
-        flood_waits=flood_waits,
-        error_rate=error_rate,
-        emoji_usage=emoji_usage,
-        hourly_stats=hourly_stats,
-    )
+    return ORJSONResponse({field: stats[field] for field in StatsResponse.model_fields})
 
 
 @app.get(f"{settings.API_PREFIX}/stats/chat/{{chat_id}}")
@@ -312,7 +320,11 @@ async def get_top_chats(
     current_user = Depends(auth_manager.get_current_user)
 ):
     """Get top performing chats"""
-    return await analytics_engine.get_top_chats(limit, days)
+    try:
+        return await analytics_engine.get_top_chats(limit, days)
+    except Exception as e:
+        logger.error(f"Analytics error (top_chats): {str(e)}")
+        return []
 
 
 @app.get(f"{settings.API_PREFIX}/settings/bot")
@@ -333,52 +345,69 @@ async def update_bot_settings(
 @app.get(f"{settings.API_PREFIX}/wallpaper", response_model=WallpaperResponse)
 async def get_wallpaper(request: Request):
     """Get cached or fresh wallpaper"""
+    global _wallpaper_cache
+    
     await auth_manager.check_rate_limit(request, "wallpaper", 10, 60)
     
+    entry = _wallpaper_cache
+    if entry and entry[0] > time.monotonic():
+        return WallpaperResponse(url=entry[1], cached=True, source="cache")
+    
     try:
-        cache_key = "wallpaper_current"
-        cached = await db.get_collection("cache").find_one({"key": cache_key})
-        
-        if cached and cached.get("expires_at") > datetime.utcnow():
-            return WallpaperResponse(url=cached["value"], cached=True, source="cache")
-        
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.get(settings.WALLPAPER_API_PRIMARY, timeout=10)
-                response.raise_for_status()
-                data = response.json()
-                url = data["results"][0]["url"]
-                source = "primary"
-            except Exception:
-                response = await client.get(settings.WALLPAPER_API_FALLBACK, timeout=10)
-                response.raise_for_status()
-                data = response.json()
-                url = data["url"]
-                source = "fallback"
+        # Concurrent misses wait here and reuse the first caller's result
+        async with _wallpaper_lock:
+            entry = _wallpaper_cache
+            if entry and entry[0] > time.monotonic():
+                return WallpaperResponse(url=entry[1], cached=True, source="cache")
+            
+            # The TTL index reaps expired documents, but only about once a
+            # minute, so an expired document can still be returned here
+            cached = await db.get_collection("cache").find_one({"key": WALLPAPER_CACHE_KEY})
+            now = datetime.utcnow()
+            ttl = (cached["expires_at"] - now).total_seconds() if cached else 0
+            
+            if ttl > 0:
+                _wallpaper_cache = (time.monotonic() + ttl, cached["value"], "cache")
+                return WallpaperResponse(url=cached["value"], cached=True, source="cache")
+            
+            url, source = await _fetch_wallpaper(request.app.state.httpx)
             
             await db.get_collection("cache").update_one(
-                {"key": cache_key},
+                {"key": WALLPAPER_CACHE_KEY},
                 {
                     "$set": {
                         "value": url,
-                        "expires_at": datetime.utcnow() + timedelta(seconds=settings.WALLPAPER_CACHE_TTL),
-                        "updated_at": datetime.utcnow(),
+                        "expires_at": now + timedelta(seconds=settings.WALLPAPER_CACHE_TTL),
+                        "updated_at": now,
                     }
                 },
                 upsert=True
             )
             
+            _wallpaper_cache = (time.monotonic() + settings.WALLPAPER_CACHE_TTL, url, source)
             return WallpaperResponse(url=url, cached=False, source=source)
     
     except Exception as e:
         logger.error(f"Wallpaper fetch error: {str(e)}")
         return WallpaperResponse(
-            url="https://i.imgur.com/rYZ5GbL.jpg",
+            url=DEFAULT_WALLPAPER_URL,
             cached=False,
             source="fallback"
         )
 
 
+async def _fetch_wallpaper(client: httpx.AsyncClient) -> Tuple[str, str]:
+    """Fetch a wallpaper URL from the primary API, falling back to the secondary"""
+    try:
+        response = await client.get(settings.WALLPAPER_API_PRIMARY)
+        response.raise_for_status()
+        return response.json()["results"][0]["url"], "primary"
+    except Exception:
+        response = await client.get(settings.WALLPAPER_API_FALLBACK)
+        response.raise_for_status()
+        return response.json()["url"], "fallback"
+
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     """WebSocket endpoint for real-time updates"""
@@ -387,7 +416,7 @@ async def websocket_endpoint(websocket: WebSocket):
     try:
         while True:
             data = await websocket.receive_text()
-            logger.debug(f"WebSocket message received: {data}")
+            await websocket_manager.handle_message(websocket, data)
     
     except WebSocketDisconnect:
         websocket_manager.disconnect(websocket)
@@ -399,12 +428,12 @@ async def websocket_endpoint(websocket: WebSocket):
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request: Request, exc: HTTPException):
     """Global HTTP exception handler"""
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=exc.status_code,
         content={
             "error": exc.detail,
             "status_code": exc.status_code,
-            "timestamp": datetime.utcnow().isoformat(),
+            "timestamp": datetime.utcnow(),
         },
     )
 
@@ -414,12 +443,12 @@ async def global_exception_handler(request: Request, exc: Exception):
     """Global exception handler"""
     logger.error(f"Unhandled exception: {str(exc)}", exc_info=True)
     
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
         content={
             "error": "Internal server error",
             "status_code": 500,
-            "timestamp": datetime.utcnow().isoformat(),
+            "timestamp": datetime.utcnow(),
         },
     )
 
@@ -432,4 +461,7 @@ if __name__ == "__main__":
         port=settings.PORT,
         reload=settings.DEBUG,
         workers=1,
+        loop="uvloop",
+        http="httptools",
+        ws_per_message_deflate=False,
     )